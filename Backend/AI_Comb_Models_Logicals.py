@@ -1,38 +1,127 @@
 from __future__ import annotations
+import copy
+import json
 import os
-from dataclasses import dataclass
-from typing import List, Optional, Dict, Any, Sequence, Tuple
-
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Optional, Dict, Any, Iterable, Sequence, Tuple
+
+import cv2
 import numpy as np
-from PIL import Image
 
 import torch
+import torch.nn.functional as F
 from torch import nn
-from torchvision import models, transforms
+from torchvision import models
 
 
 # ===========================
 # Image preprocessing
 # ===========================
-def preprocess_bgr_cv2(img_bgr: np.ndarray, size: int = 224) -> torch.Tensor:
+_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+_STD = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+
+
+@lru_cache(maxsize=8)
+def _norm_affine(device: torch.device, bgr: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Per-device (scale, shift) so that `x * scale - shift` == `(x / 255 - mean) / std`.
+    `bgr=True` gives the constants in BGR channel order, for normalizing before the swap.
+    """
+    scale, shift = 1.0 / (255.0 * _STD), _MEAN / _STD
+    if bgr:
+        scale, shift = scale.flip(1), shift.flip(1)
+    return scale.to(device), shift.to(device)
+
+
+_pinned = threading.local()
+
+
+def _to_device_pinned(arr: np.ndarray, device: torch.device) -> torch.Tensor:
+    """
+    Stage `arr` in a reusable per-thread pinned host buffer and start an async H2D copy.
+    The buffer is only rewritten once the previous copy out of it has completed.
     """
-    Convert a cv2 BGR image (H, W, 3) uint8 to a normalized tensor (1, 3, H, W).
+    prev = getattr(_pinned, "event", None)
+    if prev is not None:
+        prev.synchronize()
+    buf = getattr(_pinned, "buf", None)
+    if buf is None or buf.numel() < arr.size:
+        buf = _pinned.buf = torch.empty(arr.size, dtype=torch.uint8, pin_memory=True)
+    staged = buf[:arr.size].view(arr.shape)
+    staged.numpy()[...] = arr
+
+    t = staged.to(device, non_blocking=True)
+    _pinned.event = torch.cuda.Event()
+    _pinned.event.record(torch.cuda.current_stream(device))
+    return t
+
+
+@lru_cache(maxsize=1)
+def _preprocess_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="preprocess")
+
+
+def _device_preprocess(img: torch.Tensor, size: int, scale: torch.Tensor, shift: torch.Tensor,
+                       dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    uint8 (H, W, 3) BGR already on the target device -> normalized RGB (1, 3, size, size)
+    in channels_last and `dtype`. `scale`/`shift` are the BGR-ordered constants.
+    """
+    t = img.permute(2, 0, 1).unsqueeze(0).float()
+    t = F.interpolate(t, size=(size, size), mode="bilinear", align_corners=False, antialias=True)
+    t = t.mul_(scale).sub_(shift)
+    # BGR -> RGB and the cast to the model dtype in one strided copy per channel,
+    # straight into a channels_last buffer.
+    rgb = torch.empty((1, size, size, 3), device=t.device, dtype=dtype).permute(0, 3, 1, 2)
+    for c in range(3):
+        rgb[:, c].copy_(t[:, 2 - c])
+    return rgb
+
+
+@lru_cache(maxsize=1)
+def _fused_device_preprocess():
+    # Lets Inductor fuse the cast, channel swap and normalization around the resize.
+    # dynamic=True: uploaded images come in arbitrary (H, W).
+    return torch.compile(_device_preprocess, fullgraph=True, dynamic=True)
+
+
+def preprocess_bgr_cv2(img_bgr: np.ndarray, size: int = 224,
+                       device: Optional[torch.device] = None, fused: bool = False,
+                       dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    Convert a cv2 BGR image (H, W, 3) uint8 to a normalized tensor (1, 3, size, size).
+    On CUDA the uint8 pixels are copied to `device` once and resize, BGR->RGB, scaling
+    and normalization run there as tensor ops (`fused=True` runs them torch.compile'd),
+    producing `dtype` directly. On CPU, OpenCV's SIMD resize/cvtColor do the resize
+    and channel swap before the tensor is built (always float32).
     """
     if img_bgr is None:
         raise ValueError("img_bgr is None; please pass a valid cv2 image array")
     if img_bgr.ndim != 3 or img_bgr.shape[2] != 3:
         raise ValueError(f"Expected (H,W,3) BGR image, got shape={img_bgr.shape}")
 
-    img_rgb = img_bgr[..., ::-1]
-    pil = Image.fromarray(img_rgb)
+    if device is None or torch.device(device).type == "cpu":
+        h, w = img_bgr.shape[:2]
+        # INTER_AREA when shrinking approximates the antialiased bilinear of the CUDA path.
+        interp = cv2.INTER_AREA if (h > size or w > size) else cv2.INTER_LINEAR
+        img_rgb = cv2.cvtColor(cv2.resize(img_bgr, (size, size), interpolation=interp), cv2.COLOR_BGR2RGB)
+        scale, shift = _norm_affine(torch.device("cpu"))
+        # uint8 * float32 promotes inside the multiply, so no separate .float() pass.
+        return torch.mul(torch.from_numpy(img_rgb).permute(2, 0, 1).unsqueeze(0), scale).sub_(shift)
 
-    tfm = transforms.Compose([
-        transforms.Resize((size, size), interpolation=transforms.InterpolationMode.BILINEAR),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                             std=[0.229, 0.224, 0.225]),
-    ])
-    return tfm(pil).unsqueeze(0)
+    device = torch.device(device)
+    if device.type == "cuda" and img_bgr.dtype == np.uint8:
+        t = _to_device_pinned(img_bgr, device)
+    else:
+        t = torch.from_numpy(np.ascontiguousarray(img_bgr)).to(device)
+
+    fn = _fused_device_preprocess() if fused else _device_preprocess
+    return fn(t, size, *_norm_affine(device, bgr=True), dtype)
 
 
 # ===========================
@@ -72,6 +161,49 @@ def _load_labels_from_ckpt(ckpt: dict) -> Optional[List[str]]:
     return None
 
 
+def _load_tensorrt(path: str, device: torch.device) -> Optional[nn.Module]:
+    """
+    Load a torch_tensorrt-compiled TorchScript module; None if torch_tensorrt is unavailable
+    (the caller then falls back to the eager weights).
+    """
+    try:
+        import torch_tensorrt  # noqa: F401  (registers the TensorRT runtime ops)
+    except ImportError:
+        return None
+    return torch.jit.load(path, map_location=device).eval()
+
+
+class _OrtModule(nn.Module):
+    """
+    Minimal nn.Module facade over an onnxruntime session: float32 CPU tensor in, logits out.
+    """
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.session.run(None, {self.input_name: x.contiguous().numpy()})[0])
+
+
+def _load_onnx(path: str, threads: Optional[int] = None) -> Optional[nn.Module]:
+    """
+    Load an ONNX model into an onnxruntime CPU session with full graph optimizations and
+    `threads` intra-op threads (None: onnxruntime's default); None if onnxruntime is
+    unavailable (the caller then falls back to the other CPU paths).
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        return None
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        opts.intra_op_num_threads = threads
+    return _OrtModule(ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"]))
+
+
 # ===========================
 # Model runner
 # ===========================
@@ -81,9 +213,25 @@ class ModelRunner:
     labels: Optional[List[str]] = None
     arch: str = "resnet50"
     activation: str = "sigmoid"
+    fp16: bool = True  # half-precision weights/inputs when running on CUDA
+    cudnn_benchmark: bool = True  # on CUDA: let cuDNN benchmark conv algorithms (process-wide)
+    tf32: bool = False  # on CUDA: allow TF32 for FP32 convs/matmuls (process-wide; lowers FP32 precision)
+    compile_model: bool = False  # torch.compile(mode="reduce-overhead") + fused CUDA preprocess; validate before enabling
+    script_model: bool = False  # trace + freeze + optimize_for_inference at load, cached next to the weights
+    legacy_jit_executor: bool = False  # with script_model: turn off TorchScript's profiling executor (process-wide)
+    input_size: int = 224  # shape used for the load-time warmup forward
+    trt_path: Optional[str] = None  # pre-built torch_tensorrt module, preferred on CUDA when present
+    trt_max_batch: int = 1  # largest batch the TensorRT module was built for (export_tensorrt's max_batch)
+    onnx_path: Optional[str] = None  # ONNX model from export_onnx(), run with onnxruntime on CPU when present
+    int8_path: Optional[str] = None  # INT8 TorchScript from quantize_int8(), used on CPU unless older than the weights
+    int8_threads: Optional[int] = None  # intra-op threads for the INT8 (process-wide torch setting) and ONNX paths; None leaves the default
 
     _model: Optional[nn.Module] = None
     _device: Optional[torch.device] = None
+    _dtype: torch.dtype = torch.float32
+    _shared: Optional[Tuple["ModelRunner", nn.Module]] = None  # (trunk owner, two-head model); see share_trunk()
+    _positions: Dict[Tuple[str, ...], np.ndarray] = field(default_factory=dict)
+    _max_batch: Optional[int] = None  # set for modules built for a fixed batch size (TensorRT)
 
     def _ensure_loaded(self):
         if self._model is not None:
@@ -91,77 +239,536 @@ class ModelRunner:
 
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self._device = device
+        if device.type == "cuda":
+            # These are process-wide torch settings, so only ever switch them on when asked.
+            if self.cudnn_benchmark:
+                # Inputs have a fixed shape, so cuDNN can benchmark and cache the fastest conv algorithms.
+                torch.backends.cudnn.benchmark = True
+            if self.tf32:
+                # With fp16=False the FP32 convs/matmuls may use TF32 tensor cores (Ampere+).
+                torch.backends.cudnn.allow_tf32 = True
+                torch.set_float32_matmul_precision("high")
+
+        if self.trt_path and device.type == "cuda" and os.path.isfile(self.trt_path):
+            m = _load_tensorrt(self.trt_path, device)
+            if m is not None:
+                if self.labels is None:
+                    raise ValueError("For TensorRT modules, provide 'labels' list.")
+                self._dtype = torch.float16 if self.fp16 else torch.float32
+                self._max_batch = max(1, self.trt_max_batch)
+                self._model = m
+                return
+
+        if self.onnx_path and device.type == "cpu" and os.path.isfile(self.onnx_path):
+            m = _load_onnx(self.onnx_path, self.int8_threads)
+            if m is not None:
+                if self.labels is None:
+                    raise ValueError("For ONNX models, provide 'labels' list.")
+                self._model = m
+                return
+
+        if self.int8_path and device.type == "cpu" and self._int8_fresh():
+            if self.labels is None:
+                raise ValueError("For INT8 modules, provide 'labels' list.")
+            if self.int8_threads is not None:
+                torch.set_num_threads(self.int8_threads)
+            self._model = torch.jit.load(self.int8_path, map_location=device).eval()
+            return
 
         path = self.weights_path
         if not os.path.isfile(path):
             raise FileNotFoundError(f"Weights not found: {path}")
 
+        if self.script_model:
+            if self.legacy_jit_executor:
+                # Frozen modules are already optimized; the profiling executor would only
+                # re-specialize them on the first few calls (and again whenever the batch
+                # size changes). This is a process-wide switch, hence opt-in.
+                torch._C._jit_set_profiling_executor(False)
+            cached = self._script_cache_path()
+            if os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+                extra = {"labels.json": ""}
+                m = torch.jit.load(cached, map_location=device, _extra_files=extra)
+                self.labels = self.labels or json.loads(extra["labels.json"])
+                if device.type == "cuda" and self.fp16:
+                    self._dtype = torch.float16
+                self._warmup(m, runs=2)
+                self._model = m
+                return
+
         if path.endswith((".pt", ".ts", ".torchscript")):
-            m = torch.jit.load(path, map_location=device)
-            m.eval()
-            self._model = m.to(device)
             if self.labels is None:
                 raise ValueError("For TorchScript weights, provide 'labels' list.")
+            # map_location already places the scripted weights on `device`.
+            self._model = self._prepare_model(torch.jit.load(path, map_location=device).eval())
             return
 
-        ckpt = torch.load(path, map_location="cpu")
+        ckpt = torch.load(path, map_location=device, mmap=True, weights_only=True)
         state_dict = ckpt["state_dict"] if (isinstance(ckpt, dict) and "state_dict" in ckpt) else ckpt
 
         labels = self.labels or _load_labels_from_ckpt(ckpt)
         if labels is None:
             raise ValueError("Label names not provided and not found in checkpoint ('label_cols'/'labels').")
 
-        m = build_backbone(self.arch, num_classes=len(labels))
-
-        def _strip_prefix(sd, prefix="module."):
-            return { (k[len(prefix):] if k.startswith(prefix) else k): v for k, v in sd.items() }
+        with device:
+            m = build_backbone(self.arch, num_classes=len(labels))
 
-        try:
-            m.load_state_dict(state_dict, strict=False)
-        except RuntimeError:
-            m.load_state_dict(_strip_prefix(state_dict), strict=False)
+        # Checkpoints saved from nn.DataParallel carry a "module." prefix on every key.
+        prefix = "module."
+        if any(k.startswith(prefix) for k in state_dict):
+            state_dict = {(k[len(prefix):] if k.startswith(prefix) else k): v for k, v in state_dict.items()}
+        m.load_state_dict(state_dict, strict=True)
 
-        self._model = m.to(device).eval()
         self.labels = labels
+        self._model = self._prepare_model(m.to(device).eval())
 
-    @torch.no_grad()
-    def predict_from_bgr(self, img_bgr: np.ndarray, size: int = 224, topk: Optional[int] = None) -> Dict[str, Any]:
+    def _prepare_model(self, m: nn.Module) -> nn.Module:
         """
-        Returns:
-          {
-            "all_results": [{"label": str, "prob": float}, ...],  # sorted desc
-            "top": (label, prob) or None,
-          }
+        Final inference-time conversions applied to a loaded model on `self._device`.
+        """
+        memory_format = torch.contiguous_format
+        if self._device.type == "cuda":
+            # NHWC lets cuDNN pick its fastest (tensor-core) conv kernels; inputs match in preprocess.
+            memory_format = torch.channels_last
+            m = m.to(memory_format=memory_format)
+            if self.fp16:
+                m = m.half()
+                self._dtype = torch.float16
+        if self.compile_model:
+            m = torch.compile(m, mode="reduce-overhead", fullgraph=True, dynamic=False)
+            # Pay compilation / CUDA-graph capture here rather than on the first request.
+            self._warmup(m)
+        elif self.script_model or isinstance(m, torch.jit.ScriptModule):
+            m = self._freeze(m, cache=self.script_model)
+        return m
+
+    def _example_input(self) -> torch.Tensor:
+        memory_format = torch.channels_last if self._device.type == "cuda" else torch.contiguous_format
+        return torch.zeros(1, 3, self.input_size, self.input_size, device=self._device,
+                           dtype=self._dtype).contiguous(memory_format=memory_format)
+
+    def _warmup(self, m: nn.Module, runs: int = 1) -> None:
+        x = self._example_input()
+        with torch.inference_mode():
+            for _ in range(runs):
+                m(x)
+
+    def _int8_fresh(self) -> bool:
+        """
+        Whether `int8_path` exists and is not older than the FP32 weights it was quantized
+        from (like the script cache), so retrained weights are never shadowed by a stale file.
         """
+        if not os.path.isfile(self.int8_path):
+            return False
+        if not os.path.isfile(self.weights_path):
+            return True
+        return os.path.getmtime(self.int8_path) >= os.path.getmtime(self.weights_path)
+
+    def _script_cache_path(self) -> str:
+        # Frozen modules bake in device, dtype and memory format, so cache one per setup.
+        tag = "cuda_fp16" if self._device.type == "cuda" and self.fp16 else self._device.type
+        return f"{os.path.splitext(self.weights_path)[0]}_{tag}.ts"
+
+    def _freeze(self, m: nn.Module, cache: bool = True) -> torch.jit.ScriptModule:
+        """
+        Trace (unless already TorchScript), freeze (folds BatchNorm into the convs) and
+        optimize_for_inference `m`, optionally save it with its labels for the next load,
+        and run the warmup passes.
+        """
+        with torch.no_grad():
+            sm = m if isinstance(m, torch.jit.ScriptModule) else torch.jit.trace(m, self._example_input())
+            sm = torch.jit.optimize_for_inference(torch.jit.freeze(sm.eval()))
+        if cache:
+            try:
+                torch.jit.save(sm, self._script_cache_path(), _extra_files={"labels.json": json.dumps(self.labels)})
+            except OSError:
+                pass  # read-only model dir: still serve the frozen module, just re-freeze next time
+        self._warmup(sm, runs=2)
+        return sm
+
+    def _label_positions(self, wanted: Sequence[str]) -> np.ndarray:
+        """
+        Index of each `wanted` label in `self.labels` (-1 when absent), computed once per runner.
+        """
+        key = tuple(wanted)
+        pos = self._positions.get(key)
+        if pos is None:
+            self._ensure_loaded()
+            label_to_idx = {lbl: i for i, lbl in enumerate(self.labels)}
+            pos = np.array([label_to_idx.get(lbl, -1) for lbl in key], dtype=np.intp)
+            self._positions[key] = pos
+        return pos
+
+    def _preprocess(self, img_bgr: np.ndarray, size: int = 224) -> torch.Tensor:
+        self._ensure_loaded()
+        return preprocess_bgr_cv2(img_bgr, size=size, device=self._device,
+                                  fused=self.compile_model, dtype=self._dtype)
+
+    def _preprocess_batch(self, imgs: Sequence[np.ndarray], size: int = 224) -> torch.Tensor:
+        """
+        Preprocess several images into one (B, 3, size, size) batch. Images are handled
+        on a small thread pool (OpenCV and torch release the GIL).
+        """
+        if len(imgs) == 1:
+            return self._preprocess(imgs[0], size=size)
         self._ensure_loaded()
-        x = preprocess_bgr_cv2(img_bgr, size=size).to(self._device)
+        device, fused, dtype = self._device, self.compile_model, self._dtype
+        return torch.cat(list(_preprocess_pool().map(
+            lambda img: preprocess_bgr_cv2(img, size=size, device=device, fused=fused, dtype=dtype), imgs)))
 
-        logits = self._model(x)
+    def _forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Run the model on a preprocessed batch and return probabilities (B, C).
+        """
+        if self._max_batch is not None and x.shape[0] > self._max_batch:
+            return torch.cat([self._forward(chunk) for chunk in x.split(self._max_batch)])
+        logits = self._model(x.to(self._dtype))
         if isinstance(logits, (list, tuple)):
             logits = logits[0]
+        return self._activate(logits)
+
+    def _activate(self, logits: torch.Tensor) -> torch.Tensor:
         if logits.ndim == 1:
             logits = logits.unsqueeze(0)
+        logits = logits.float()
 
         if self.activation == "softmax":
-            probs = torch.softmax(logits, dim=1)[0]
+            return torch.softmax(logits, dim=1)
+        return torch.sigmoid(logits)
+
+    def _results(self, probs: torch.Tensor, topk: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        One result dict per row of `probs` (B, C). Ranking runs on-device and only the
+        (value, index) pairs that are returned are copied to the host.
+        """
+        num_classes = probs.shape[1]
+        labels = self.labels or [f"class_{i}" for i in range(num_classes)]
+
+        if topk is not None:
+            vals, idx = torch.topk(probs, k=max(0, min(topk, num_classes)), dim=1)
         else:
-            probs = torch.sigmoid(logits)[0]
+            vals, idx = torch.sort(probs, dim=1, descending=True, stable=True)
+
+        out = []
+        for row_idx, row_vals in zip(idx.tolist(), vals.float().tolist()):
+            pairs = [(labels[i], p) for i, p in zip(row_idx, row_vals)]
+            out.append({
+                "all_results": [{"label": n, "prob": p} for (n, p) in pairs],
+                "top": pairs[0] if pairs else None
+            })
+        return out
+
+    @torch.inference_mode()
+    def predict_probs_batch_from_bgr(self, imgs: Sequence[np.ndarray], size: int = 224) -> np.ndarray:
+        """
+        Returns probabilities (B, C) as a contiguous float32 array for several images,
+        computed in a single forward pass; columns follow `self.labels`.
+        """
+        return _probs_to_numpy(self._forward(self._preprocess_batch(imgs, size=size)))
 
-        probs_np = probs.detach().float().cpu().numpy()
-        labels = self.labels or [f"class_{i}" for i in range(probs_np.shape[0])]
+    @torch.inference_mode()
+    def predict_batch_from_bgr(self, imgs: Sequence[np.ndarray], size: int = 224,
+                               topk: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Batched `predict_from_bgr`: one forward pass, one result dict per input image.
+        """
+        return self._results(self._forward(self._preprocess_batch(imgs, size=size)), topk=topk)
 
-        pairs = list(zip(labels, probs_np.tolist()))
-        pairs.sort(key=lambda x: x[1], reverse=True)
+    def predict_probs_from_bgr(self, img_bgr: np.ndarray, size: int = 224) -> np.ndarray:
+        """
+        Returns the raw probability vector (C,) as a contiguous float32 array,
+        in the same order as `self.labels`.
+        """
+        return self.predict_probs_batch_from_bgr([img_bgr], size=size)[0]
+
+    def predict_from_bgr(self, img_bgr: np.ndarray, size: int = 224, topk: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Returns:
+          {
+            "all_results": [{"label": str, "prob": float}, ...],  # sorted desc
+            "top": (label, prob) or None,
+          }
+        """
+        return self.predict_batch_from_bgr([img_bgr], size=size, topk=topk)[0]
+
+
+def _probs_to_numpy(probs: torch.Tensor) -> np.ndarray:
+    return np.ascontiguousarray(probs.detach().float().cpu().numpy())
+
+
+def export_tensorrt(runner: ModelRunner, out_path: str, size: int = 224, max_batch: int = 1) -> str:
+    """
+    One-time conversion of a runner's eager model to a TensorRT module for
+    (1..max_batch, 3, size, size) inputs, optimized for batch=1, in the runner's precision.
+    Point `trt_path` at the result and set `trt_max_batch` to the same `max_batch`.
+    """
+    import torch_tensorrt
+
+    runner._ensure_loaded()
+    if runner._device.type != "cuda":
+        raise RuntimeError("TensorRT export requires a CUDA device.")
+    if runner.compile_model or runner.trt_path:
+        raise ValueError("Export from a plain eager runner (compile_model=False, trt_path=None).")
+
+    dtype = runner._dtype
+    trt_mod = torch_tensorrt.compile(
+        runner._model, ir="ts",
+        inputs=[torch_tensorrt.Input(min_shape=(1, 3, size, size), opt_shape=(1, 3, size, size),
+                                     max_shape=(max(1, max_batch), 3, size, size), dtype=dtype)],
+        enabled_precisions={dtype},
+    )
+    torch.jit.save(trt_mod, out_path)
+    return out_path
+
+
+@torch.no_grad()
+def export_onnx(runner: ModelRunner, out_path: str, size: int = 224, quantize: bool = True) -> str:
+    """
+    One-time export of a runner's eager CPU model to ONNX (dynamic batch axis). With
+    `quantize=True` the weights are then INT8 dynamic-quantized by onnxruntime (VNNI
+    kernels on supported CPUs). Point `onnx_path` at the result.
+    """
+    runner._ensure_loaded()
+    if runner._device.type != "cpu":
+        raise RuntimeError("ONNX export targets CPU inference; run it on a CPU-only host.")
+    if runner.compile_model or isinstance(runner._model, (torch.jit.ScriptModule, _OrtModule)):
+        raise ValueError("Export from a plain eager runner (compile_model=False, no INT8/ONNX module loaded).")
+
+    fp32_path = out_path + ".fp32.onnx" if quantize else out_path
+    torch.onnx.export(
+        runner._model, torch.zeros(1, 3, size, size), fp32_path, opset_version=17,
+        input_names=["input"], output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+    )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(fp32_path, out_path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    return out_path
+
+
+@torch.no_grad()
+def quantize_int8(runner: ModelRunner, calib_images: Iterable[np.ndarray], out_path: str, size: int = 224) -> str:
+    """
+    One-time FX graph-mode post-training static quantization (x86 backend) of a runner's
+    eager CPU model, calibrated on a few dozen representative BGR images. Saves a traced
+    INT8 TorchScript module; point `int8_path` at it (re-run after retraining the weights).
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    runner._ensure_loaded()
+    if runner._device.type != "cpu":
+        raise RuntimeError("INT8 quantization targets CPU inference; run it on a CPU-only host.")
+    if runner.compile_model or isinstance(runner._model, (torch.jit.ScriptModule, _OrtModule)):
+        raise ValueError("Quantize from a plain eager runner (compile_model=False, no INT8/ONNX module loaded).")
+
+    example = torch.zeros(1, 3, size, size)
+    prepared = prepare_fx(copy.deepcopy(runner._model), get_default_qconfig_mapping("x86"), (example,))
+    for img in calib_images:
+        prepared(preprocess_bgr_cv2(img, size=size, device=runner._device))
+    quantized = convert_fx(prepared)
+    torch.jit.save(torch.jit.trace(quantized, example), out_path)
+    return out_path
 
-        if topk is not None:
-            pairs = pairs[:topk]
 
-        top = pairs[0] if pairs else None
+class TwoHeadResNet(nn.Module):
+    """
+    One ResNet trunk (everything up to and including the pooling/flatten) feeding two
+    linear heads; returns (logits_a, logits_b).
+    """
+
+    def __init__(self, trunk: nn.Module, head_a: nn.Module, head_b: nn.Module):
+        super().__init__()
+        self.trunk = trunk
+        self.head_a = head_a
+        self.head_b = head_b
 
-        return {
-            "all_results": [{"label": n, "prob": float(p)} for (n, p) in pairs],
-            "top": top
-        }
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        feats = self.trunk(x)
+        return self.head_a(feats), self.head_b(feats)
+
+
+@torch.no_grad()
+def _distill_head(trunk: nn.Module, teacher: nn.Module, head: nn.Linear,
+                  imgs: Iterable[np.ndarray], device: torch.device, dtype: torch.dtype,
+                  size: int = 224, ridge: float = 1e-3) -> None:
+    """
+    Re-fit `head` in place so that head(trunk(x)) matches teacher(x) on `imgs`
+    (least squares on the logits, solved in float32). `ridge` is relative to the
+    mean feature energy, so it does not depend on the trunk's activation scale.
+    """
+    feats, targets = [], []
+    for img in imgs:
+        x = preprocess_bgr_cv2(img, size=size, device=device, dtype=dtype)
+        feats.append(trunk(x).float())
+        targets.append(teacher(x).float())
+    if not feats:
+        raise ValueError("No calibration images to re-fit the shared head on.")
+
+    f = torch.cat(feats)
+    f = torch.cat([f, f.new_ones(f.shape[0], 1)], dim=1)  # bias column
+    gram = f.T @ f
+    gram += ridge * gram.diagonal().mean() * torch.eye(f.shape[1], device=f.device)
+    w = torch.linalg.solve(gram, f.T @ torch.cat(targets))  # (in + 1, out)
+    head.weight.copy_(w[:-1].T.to(head.weight.dtype))
+    head.bias.copy_(w[-1].to(head.bias.dtype))
+
+
+def _resnet_pair(a: ModelRunner, b: ModelRunner) -> Tuple[models.ResNet, models.ResNet]:
+    a._ensure_loaded()
+    b._ensure_loaded()
+    ma, mb = a._model, b._model
+    if not (isinstance(ma, models.ResNet) and isinstance(mb, models.ResNet)):
+        raise ValueError("share_trunk needs eager torchvision ResNets (no TorchScript/TensorRT/INT8/compile).")
+    if a._device != b._device or a._dtype != b._dtype:
+        raise ValueError("share_trunk needs both runners on the same device and dtype.")
+    return ma, mb
+
+
+def _resnet_trunk(m: models.ResNet) -> nn.Module:
+    return nn.Sequential(*list(m.children())[:-1], nn.Flatten(1))
+
+
+@torch.no_grad()
+def _head_agreement(trunk: nn.Module, teacher: nn.Module, head: nn.Linear, runner: ModelRunner,
+                    imgs: Iterable[np.ndarray], size: int = 224) -> Dict[str, float]:
+    """
+    How closely runner-activated head(trunk(x)) follows teacher(x) on `imgs`: mean absolute
+    probability error and top-1 agreement.
+    """
+    err, agree, n = 0.0, 0, 0
+    for img in imgs:
+        x = preprocess_bgr_cv2(img, size=size, device=runner._device, dtype=runner._dtype)
+        ref = runner._activate(teacher(x))
+        got = runner._activate(head(trunk(x)))
+        err += float((got - ref).abs().mean())
+        agree += int(got.argmax(1).item() == ref.argmax(1).item())
+        n += 1
+    if not n:
+        raise ValueError("No validation images to check the distilled head against.")
+    return {"mean_abs_prob_err": err / n, "top1_agreement": agree / n, "images": n}
+
+
+def distill_shared_head(a: ModelRunner, b: ModelRunner, calib_images: Iterable[np.ndarray],
+                        val_images: Iterable[np.ndarray], out_path: str, size: int = 224,
+                        ridge: float = 1e-3, max_prob_err: float = 0.02,
+                        min_top1: float = 0.95) -> Dict[str, float]:
+    """
+    Offline step for share_trunk() with independently fine-tuned checkpoints: re-fit `b`'s
+    head onto `a`'s trunk against `b`'s original outputs on `calib_images` (a few hundred
+    representative BGR images), then compare it with the original model on held-out
+    `val_images`. The head is saved to `out_path` (for share_trunk's `head_path`) only if
+    it stays within `max_prob_err` and `min_top1`; otherwise ValueError. Returns the metrics.
+    """
+    ma, mb = _resnet_pair(a, b)
+    trunk = _resnet_trunk(ma)
+    head = copy.deepcopy(mb.fc)
+    _distill_head(trunk, mb, head, calib_images, a._device, a._dtype, size=size, ridge=ridge)
+
+    metrics = _head_agreement(trunk, mb, head, b, val_images, size=size)
+    if metrics["mean_abs_prob_err"] > max_prob_err or metrics["top1_agreement"] < min_top1:
+        raise ValueError(f"Distilled head does not match the original model closely enough: {metrics}")
+    torch.save({
+        "state_dict": {k: v.float().cpu() for k, v in head.state_dict().items()},
+        "labels": b.labels,
+        "metrics": metrics,
+    }, out_path)
+    return metrics
+
+
+def share_trunk(a: ModelRunner, b: ModelRunner, head_path: Optional[str] = None) -> TwoHeadResNet:
+    """
+    Make `b` reuse `a`'s ResNet trunk and keep only its own `fc` head, so the combined
+    pipeline runs the trunk once and `b`'s trunk weights are released.
+
+    As-is this is only correct when `b`'s head was trained on `a`'s trunk features
+    (see trunks_match). For independently fine-tuned checkpoints pass `head_path`: a head
+    produced and validated offline by distill_shared_head(). Both runners must be plain
+    eager ResNets.
+    """
+    ma, mb = _resnet_pair(a, b)
+    trunk = _resnet_trunk(ma)
+    head = mb.fc
+    if head_path is not None:
+        ckpt = torch.load(head_path, map_location=a._device, weights_only=True)
+        if ckpt.get("labels") != b.labels:
+            raise ValueError(f"Shared head {head_path} was distilled for different labels.")
+        head = copy.deepcopy(mb.fc)
+        head.load_state_dict(ckpt["state_dict"])
+
+    b._model = nn.Sequential(trunk, head).eval()
+    b._shared = (a, TwoHeadResNet(trunk, ma.fc, head).eval())
+    return b._shared[1]
+
+
+def trunks_match(a: ModelRunner, b: ModelRunner) -> bool:
+    """
+    True when `a` and `b` are eager ResNets on the same device/dtype whose weights are
+    identical everywhere except the `fc` head (e.g. heads fine-tuned on a frozen backbone),
+    so share_trunk(a, b) is exact without calibration.
+    """
+    a._ensure_loaded()
+    b._ensure_loaded()
+    ma, mb = a._model, b._model
+    if not (isinstance(ma, models.ResNet) and isinstance(mb, models.ResNet)):
+        return False
+    if a._device != b._device or a._dtype != b._dtype:
+        return False
+    sa, sb = ma.state_dict(), mb.state_dict()
+    keys = [k for k in sa if not k.startswith("fc.")]
+    if keys != [k for k in sb if not k.startswith("fc.")]:
+        return False
+    return all(torch.equal(sa[k], sb[k]) for k in keys)
+
+
+_streams = threading.local()
+
+
+def _side_streams(device: torch.device) -> Tuple[torch.cuda.Stream, torch.cuda.Stream]:
+    """
+    The calling thread's pair of side streams on `device`, created on first use.
+    Per-thread so concurrent requests don't queue behind each other on shared streams.
+    """
+    pairs = getattr(_streams, "pairs", None)
+    if pairs is None:
+        pairs = _streams.pairs = {}
+    pair = pairs.get(device)
+    if pair is None:
+        pair = pairs[device] = (torch.cuda.Stream(device), torch.cuda.Stream(device))
+    return pair
+
+
+@torch.inference_mode()
+def _forward_pair(a: ModelRunner, b: ModelRunner, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run two loaded runners on the same preprocessed input. On CUDA each forward
+    gets its own stream so the two (batch=1, under-occupied) ResNets overlap.
+    When `b` shares `a`'s trunk (share_trunk), a single two-head forward is used instead.
+    """
+    if b._shared is not None and b._shared[0] is a:
+        logits_a, logits_b = b._shared[1](x.to(a._dtype))
+        return a._activate(logits_a), b._activate(logits_b)
+
+    if not x.is_cuda:
+        return a._forward(x), b._forward(x)
+
+    main = torch.cuda.current_stream(x.device)
+    sa, sb = _side_streams(x.device)
+    sa.wait_stream(main)
+    sb.wait_stream(main)
+    with torch.cuda.stream(sa):
+        pa = a._forward(x)
+    with torch.cuda.stream(sb):
+        pb = b._forward(x)
+    main.wait_stream(sa)
+    main.wait_stream(sb)
+    x.record_stream(sa)
+    x.record_stream(sb)
+    pa.record_stream(main)
+    pb.record_stream(main)
+    return pa, pb
 
 
 # ===========================
@@ -209,54 +816,112 @@ LESION_TO_CONCERN: Dict[str, Optional[str]] = {
 # ===========================
 # Combination logic (your spec)
 # ===========================
-def _pick_skin_type(prob_map: Dict[str, float], skin_type_labels: Sequence[str]) -> Dict[str, float]:
-    best_label = max(skin_type_labels, key=lambda k: prob_map.get(k, 0.0))
-    return {"label": best_label, "prob": float(prob_map.get(best_label, 0.0))}
+def _pick_skin_type(cond_probs: np.ndarray,
+                    skin_pos: np.ndarray,
+                    skin_type_labels: Sequence[str]) -> Dict[str, float]:
+    type_probs = np.where(skin_pos >= 0, cond_probs[skin_pos], 0.0)
+    best = int(np.argmax(type_probs))
+    return {"label": skin_type_labels[best], "prob": float(type_probs[best])}
+
+
+@lru_cache(maxsize=16)
+def _concern_index(labels: Tuple[str, ...],
+                   mapping_items: Tuple[Tuple[str, Optional[str]], ...]) -> Tuple[np.ndarray, Tuple[str, ...]]:
+    """
+    Precompute label index -> concern id (-1 when unmapped) and the concern names by id.
+    """
+    mapping = dict(mapping_items)
+    names = tuple(dict.fromkeys(c for c in map(mapping.get, labels) if c))
+    concern_to_id = {c: i for i, c in enumerate(names)}
+    idx = np.array([concern_to_id.get(mapping.get(lbl), -1) for lbl in labels], dtype=np.intp)
+    return idx, names
 
 
-def _skin_concerns_from_conditions(all_results: List[Dict[str, Any]],
-                                   skin_type_labels: Sequence[str],
+def _skin_concerns_from_conditions(cond_probs: np.ndarray,
+                                   cond_labels: Sequence[str],
+                                   skin_pos: np.ndarray,
                                    threshold: float = 0.15) -> List[Dict[str, float]]:
-    out = []
-    for d in all_results:
-        lbl, p = d["label"], float(d["prob"])
-        if lbl in skin_type_labels:
-            continue
-        if p >= threshold:
-            out.append({"label": lbl, "prob": p})
-    out.sort(key=lambda x: x["prob"], reverse=True)
-    return out
+    above = cond_probs >= threshold
+    above[skin_pos[skin_pos >= 0]] = False
+    keep = np.flatnonzero(above)
+    keep = keep[np.argsort(-cond_probs[keep], kind="stable")]
+    return [{"label": cond_labels[i], "prob": float(cond_probs[i])} for i in keep]
 
 
-def _agg_lesions_to_concerns_by_max(lesion_results: List[Dict[str, Any]],
-                                    mapping: Dict[str, Optional[str]]) -> Dict[str, float]:
+def _agg_lesions_to_concerns_by_max(lesion_probs: np.ndarray,
+                                    lesion_labels: Sequence[str],
+                                    mapping: Dict[str, Optional[str]]) -> Tuple[Tuple[str, ...], np.ndarray]:
     """
     Map lesion labels -> concern names and aggregate by **maximum** probability per concern.
+    Returns (concern_names, probs) with probs[i] belonging to concern_names[i].
     """
-    agg: Dict[str, float] = {}
-    for d in lesion_results:
-        lesion_label = d["label"]
-        p = float(d["prob"])
-        concern = mapping.get(lesion_label)
-        if not concern:
-            continue
-        if concern not in agg or p > agg[concern]:
-            agg[concern] = p
-    return agg
+    idx, names = _concern_index(tuple(lesion_labels), tuple(mapping.items()))
+    mapped = idx >= 0
+    agg = np.full(len(names), -1.0, dtype=np.float64)
+    np.maximum.at(agg, idx[mapped], lesion_probs[mapped])
+    return names, agg
 
 
-def _split_other_concerns(agg_concern_probs: Dict[str, float],
+def _split_other_concerns(concern_names: Sequence[str],
+                          concern_probs: np.ndarray,
                           high_thr: float = 0.30,
                           low_thr: float = 0.15) -> Tuple[List[Dict[str, float]], List[Dict[str, float]]]:
-    other, low = [], []
-    for lbl, p in agg_concern_probs.items():
-        if p >= high_thr:
-            other.append({"label": lbl, "prob": float(p)})
-        elif p >= low_thr:
-            low.append({"label": lbl, "prob": float(p)})
-    other.sort(key=lambda x: x["prob"], reverse=True)
-    low.sort(key=lambda x: x["prob"], reverse=True)
-    return other, low
+    order = np.argsort(-concern_probs, kind="stable")
+    p = concern_probs[order]
+    other = order[p >= high_thr]
+    low = order[(p < high_thr) & (p >= low_thr)]
+    return (
+        [{"label": concern_names[i], "prob": float(concern_probs[i])} for i in other],
+        [{"label": concern_names[i], "prob": float(concern_probs[i])} for i in low],
+    )
+
+
+@torch.inference_mode()
+def run_combined_AI_batch_from_cv2(
+    imgs: Sequence[np.ndarray],
+    lesions_runner: ModelRunner,
+    conditions_runner: ModelRunner,
+    size: int = 224,
+    skin_type_labels: Sequence[str] = ("Oily Skin", "Dry Skin", "Normal Skin"),
+    cond_threshold: float = 0.15,
+    lesion_high_thr: float = 0.30,
+    lesion_low_thr: float = 0.15,
+    lesion_mapping: Dict[str, Optional[str]] = LESION_TO_CONCERN,
+) -> List[Dict[str, Any]]:
+    """
+    Batched `run_combined_AI_from_cv2`: both models see all images in one forward pass;
+    returns one combined dict per image, in input order.
+    """
+    lesions_runner._ensure_loaded()
+    x = conditions_runner._preprocess_batch(imgs, size=size)
+    cond_probs, lesion_probs = _forward_pair(conditions_runner, lesions_runner, x)
+
+    # One D2H copy (and one sync) for both models' probabilities; the post-processing
+    # below works on ~60 floats per image, which is cheaper on the host than more launches.
+    n_cond = cond_probs.shape[1]
+    probs_np = _probs_to_numpy(torch.cat([cond_probs, lesion_probs], dim=1))
+    cond_np, lesion_np = probs_np[:, :n_cond], probs_np[:, n_cond:]
+    cond_labels = conditions_runner.labels
+    lesion_labels = lesions_runner.labels
+    skin_pos = conditions_runner._label_positions(skin_type_labels)
+
+    out = []
+    for cond_row, lesion_row in zip(cond_np, lesion_np):
+        skin_type = _pick_skin_type(cond_row, skin_pos, skin_type_labels)
+
+        skin_concerns = _skin_concerns_from_conditions(cond_row, cond_labels, skin_pos, threshold=cond_threshold)
+
+        concern_names, concern_probs = _agg_lesions_to_concerns_by_max(lesion_row, lesion_labels, lesion_mapping)
+
+        other_concerns, low_concerns = _split_other_concerns(concern_names, concern_probs, high_thr=lesion_high_thr, low_thr=lesion_low_thr)
+
+        out.append({
+            "skin_type": skin_type,
+            "skin_concerns": skin_concerns,
+            "other_concerns": other_concerns,
+            "low_concerns": low_concerns,
+        })
+    return out
 
 
 def run_combined_AI_from_cv2(
@@ -271,29 +936,80 @@ def run_combined_AI_from_cv2(
     lesion_mapping: Dict[str, Optional[str]] = LESION_TO_CONCERN,
 ) -> Dict[str, Any]:
 
-    cond_raw = conditions_runner.predict_from_bgr(img_bgr, size=size, topk=None)
-    lesion_raw = lesions_runner.predict_from_bgr(img_bgr, size=size, topk=None)
+    return run_combined_AI_batch_from_cv2(
+        [img_bgr], lesions_runner, conditions_runner,
+        size=size, skin_type_labels=skin_type_labels, cond_threshold=cond_threshold,
+        lesion_high_thr=lesion_high_thr, lesion_low_thr=lesion_low_thr, lesion_mapping=lesion_mapping,
+    )[0]
 
-    cond_map = {d["label"]: float(d["prob"]) for d in cond_raw["all_results"]}
-    skin_type = _pick_skin_type(cond_map, skin_type_labels)
 
-    skin_concerns = _skin_concerns_from_conditions(cond_raw["all_results"], skin_type_labels, threshold=cond_threshold)
+class CombinedBatcher:
+    """
+    Micro-batcher for concurrent single-image callers (e.g. Flask request threads).
+    Requests queue up for at most `max_wait_ms` (or until `max_batch` arrive) and a
+    worker thread runs them through `run_combined_AI_batch_from_cv2` as one batch.
+    Extra keyword arguments are passed through to it (size, thresholds, ...).
+    """
 
-    agg = _agg_lesions_to_concerns_by_max(lesion_raw["all_results"], lesion_mapping)
-
-    other_concerns, low_concerns = _split_other_concerns(agg, high_thr=lesion_high_thr, low_thr=lesion_low_thr)
-
-    return {
-        "skin_type": skin_type,
-        "skin_concerns": skin_concerns,
-        "other_concerns": other_concerns,
-        "low_concerns": low_concerns,
-    }
+    def __init__(self, lesions_runner: ModelRunner, conditions_runner: ModelRunner,
+                 max_batch: int = 8, max_wait_ms: float = 5.0, **combine_kwargs):
+        self.lesions_runner = lesions_runner
+        self.conditions_runner = conditions_runner
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self.combine_kwargs = combine_kwargs
+        self._queue: "queue.Queue[Tuple[np.ndarray, Future]]" = queue.Queue()
+        threading.Thread(target=self._loop, name="combined-batcher", daemon=True).start()
+
+    def submit(self, img_bgr: np.ndarray) -> Future:
+        fut: Future = Future()
+        self._queue.put((img_bgr, fut))
+        return fut
+
+    def __call__(self, img_bgr: np.ndarray) -> Dict[str, Any]:
+        return self.submit(img_bgr).result()
+
+    def _next_group(self) -> List[Tuple[np.ndarray, Future]]:
+        group = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(group) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [(img, fut) for img, fut in group if fut.set_running_or_notify_cancel()]
+
+    def _loop(self) -> None:
+        while True:
+            group = self._next_group()
+            if not group:
+                continue
+            try:
+                results = run_combined_AI_batch_from_cv2(
+                    [img for img, _ in group], self.lesions_runner, self.conditions_runner, **self.combine_kwargs)
+            except Exception as e:
+                for _, fut in group:
+                    fut.set_exception(e)
+            else:
+                for (_, fut), res in zip(group, results):
+                    fut.set_result(res)
 
 
 # ===========================
 # Merge helper (optional)
 # ===========================
+# Section -> source tag, in bit order (bit0=conditions, bit1=lesions, bit2=lesions-low).
+_MERGE_SECTIONS = ("skin_concerns", "other_concerns", "low_concerns")
+_MERGE_TAGS = ("conditions", "lesions", "lesions-low")
+_SOURCE_TAGS = tuple(
+    tuple(tag for bit, tag in enumerate(_MERGE_TAGS) if bits & (1 << bit))
+    for bits in range(1 << len(_MERGE_TAGS))
+)
+
+
 def merge_concerns_sections(combined: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
     """
     Merge 'skin_concerns', 'other_concerns', and 'low_concerns' into a single dict:
@@ -305,28 +1021,18 @@ def merge_concerns_sections(combined: Dict[str, Any]) -> Dict[str, Dict[str, Any
         "lesions"      -> from other_concerns (lesion mapping, >=0.30)
         "lesions-low"  -> from low_concerns (lesion mapping, 0.15–0.30)
     """
-    merged: Dict[str, Dict[str, Any]] = {}
+    probs: Dict[str, float] = {}
+    source_bits: Dict[str, int] = {}
 
-    for d in combined.get("skin_concerns", []):
-        lbl, p = d["label"], float(d["prob"])
-        merged[lbl] = {"prob": p, "source": ["conditions"]}
+    for bit, key in enumerate(_MERGE_SECTIONS):
+        flag = 1 << bit
+        for d in combined.get(key, []):
+            lbl, p = d["label"], float(d["prob"])
+            prev = probs.get(lbl)
+            probs[lbl] = p if prev is None or p > prev else prev
+            source_bits[lbl] = source_bits.get(lbl, 0) | flag
 
-    for d in combined.get("other_concerns", []):
-        lbl, p = d["label"], float(d["prob"])
-        if lbl in merged:
-            merged[lbl]["prob"] = max(merged[lbl]["prob"], p)
-            if "lesions" not in merged[lbl]["source"]:
-                merged[lbl]["source"].append("lesions")
-        else:
-            merged[lbl] = {"prob": p, "source": ["lesions"]}
-
-    for d in combined.get("low_concerns", []):
-        lbl, p = d["label"], float(d["prob"])
-        if lbl in merged:
-            merged[lbl]["prob"] = max(merged[lbl]["prob"], p)
-            if "lesions-low" not in merged[lbl]["source"]:
-                merged[lbl]["source"].append("lesions-low")
-        else:
-            merged[lbl] = {"prob": p, "source": ["lesions-low"]}
-
-    return merged
\ No newline at end of file
+    return {
+        lbl: {"prob": p, "source": list(_SOURCE_TAGS[source_bits[lbl]])}
+        for lbl, p in probs.items()
+    }
@@ -1,16 +1,27 @@
 # ===========================
 # IMPORTS
 # ===========================
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+
 import cv2
+import torch
+
+from AI_Comb_Models_Logicals import ModelRunner, run_combined_AI_batch_from_cv2, run_combined_AI_from_cv2
+
 
-from AI_Comb_Models_Logicals import ModelRunner, run_combined_AI_from_cv2
+# Inference-only script: no autograd bookkeeping anywhere in this process.
+torch.set_grad_enabled(False)
 
 
 # ===========================
-# AI INFERENCE FUNCTION
+# MODEL RUNNERS (loaded once per process)
 # ===========================
-def run_simple_ai(img):
-    lesions = ModelRunner(
+@lru_cache(maxsize=1)
+def get_lesions_runner() -> ModelRunner:
+    return ModelRunner(
         weights_path="Skin_dis_Models/best_model.pth",
         labels=[
             "Erythema","Patch","Papule","Plaque","Macule","Pustule","Crust",
@@ -26,27 +37,65 @@ def run_simple_ai(img):
         activation="sigmoid",
     )
 
-    conditions = ModelRunner(
+
+@lru_cache(maxsize=1)
+def get_conditions_runner() -> ModelRunner:
+    return ModelRunner(
         weights_path="Skin_conditions_Models/skin_type_best.pth",
         labels=["Acne","Dark Spots","Oily Skin","Normal Skin","Blackheads","Dry Skin","Wrinkles"],
         arch="resnet50",
         activation="sigmoid",
     )
 
-    img_bgr = cv2.imread(img)
 
-    combined = run_combined_AI_from_cv2(
-        img_bgr, lesions_runner=lesions, conditions_runner=conditions,
+# ===========================
+# AI INFERENCE FUNCTION
+# ===========================
+def _run_on_bgr(img_bgr):
+    return run_combined_AI_from_cv2(
+        img_bgr, lesions_runner=get_lesions_runner(), conditions_runner=get_conditions_runner(),
         size=224, cond_threshold=0.15, lesion_high_thr=0.30, lesion_low_thr=0.15
     )
 
+
+def _run_on_bgr_batch(imgs_bgr):
+    return run_combined_AI_batch_from_cv2(
+        imgs_bgr, lesions_runner=get_lesions_runner(), conditions_runner=get_conditions_runner(),
+        size=224, cond_threshold=0.15, lesion_high_thr=0.30, lesion_low_thr=0.15
+    )
+
+
+def run_simple_ai(img):
+    img_bgr = cv2.imread(img)
+
+    combined = _run_on_bgr(img_bgr)
+
     return combined
 
 
+def iter_simple_ai(imgs, prefetch=4, batch_size=8):
+    """
+    Run the combined AI over many image paths, yielding (path, combined) in order.
+    Upcoming images are decoded on a background thread while the current group is on
+    the models, so JPEG decode overlaps inference; each group of up to `batch_size`
+    images goes through both models as a single batch.
+    """
+    paths = iter(imgs)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = deque((p, pool.submit(cv2.imread, p)) for p in islice(paths, max(prefetch, batch_size)))
+        while pending:
+            group = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            for nxt in islice(paths, len(group)):
+                pending.append((nxt, pool.submit(cv2.imread, nxt)))
+            results = _run_on_bgr_batch([fut.result() for _, fut in group])
+            yield from zip((path for path, _ in group), results)
+
+
 # ===========================
 # MAIN EXECUTION
 # ===========================
-img = "test.jpg"
-result = run_simple_ai(img)
+if __name__ == "__main__":
+    img = "test.jpg"
+    result = run_simple_ai(img)
 
-print(result)
\ No newline at end of file
+    print(result)
@@ -1,39 +1,50 @@
+import atexit
 import base64
 import csv
+import hashlib
 import io
 import os
+import queue
 import re
+import secrets
+import shutil
 import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import timedelta, datetime
-from functools import wraps
-from pathlib import Path
-from urllib.parse import urljoin
+from functools import lru_cache, wraps
+from urllib.parse import parse_qs, urljoin, urlsplit
 
 # -------- AI imports --------
+import bcrypt
 import cv2
-from bson import ObjectId
+import numpy as np
+import orjson
+from bson import ObjectId, json_util
+import click
 from dotenv import load_dotenv
 from flask import (
     Flask, Blueprint, request, jsonify, render_template,
-    redirect, url_for, session, flash, abort, Response
+    redirect, url_for, session, flash, abort, Response, g
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_jwt_extended import (
     JWTManager, create_access_token, create_refresh_token,
     jwt_required, get_jwt_identity
 )
 from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import generate_csrf
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.security import check_password_hash
 from wtforms import Form, StringField, PasswordField, FloatField
 from wtforms.validators import DataRequired, Email, Length, Optional
 
 from AI_Comb_Models_Logicals import (
-    ModelRunner, run_combined_AI_from_cv2,
-    merge_concerns_sections
+    CombinedBatcher, ModelRunner, run_combined_AI_from_cv2,
+    distill_shared_head, merge_concerns_sections, share_trunk, trunks_match
 )
 
 load_dotenv()
@@ -41,7 +52,25 @@ load_dotenv()
 # =============================================================================
 # App setup
 # =============================================================================
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    jsonify/app.json backed by orjson. Datetimes and other non-native types still go through
+    Flask's default hook, so responses keep the same shape as with the stdlib provider.
+    """
+    _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def _dumpb(self, obj):
+        return orjson.dumps(obj, default=self.default, option=self._OPTIONS)
+
+    def dumps(self, obj, **kwargs):
+        return self._dumpb(obj).decode("utf-8")
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumpb(obj), mimetype=self.mimetype)
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
+app.json = OrjsonProvider(app)
 
 # --- Core config ---
 app.config["MONGO_URI"] = os.getenv("MONGO_URI", "mongodb://localhost:27017/beauty_commerce")
@@ -51,6 +80,8 @@ app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=30)
 app.config["JWT_TOKEN_LOCATION"] = ["headers"]
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY", "dev-session-secret-change-me")
 app.config["WTF_CSRF_TIME_LIMIT"] = 60 * 60 * 8
+# bcrypt cost factor; raise it until hash_password takes ~250 ms on the production hosts.
+app.config["BCRYPT_ROUNDS"] = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
 # --- Uploads ---
 app.config["MAX_CONTENT_LENGTH"] = 12 * 1024 * 1024
@@ -60,7 +91,33 @@ os.makedirs(UPLOAD_PRODUCTS_DIR, exist_ok=True)
 os.makedirs(UPLOAD_FACES_DIR, exist_ok=True)
 ALLOWED_IMG_EXT = {".png", ".jpg", ".jpeg", ".webp"}
 
-mongo = PyMongo(app)
+# One pooled MongoClient per process: keep warm connections so requests don't pay the
+# connect/auth handshake, and fail fast when the pool is exhausted. MongoClient keyword
+# arguments override MONGO_URI's query string, so an option is only passed when its MONGO_*
+# env var is set, or (for the pool defaults below) when MONGO_URI does not set it itself.
+# MONGO_COMPRESSORS (e.g. "zstd,snappy,zlib") turns on wire compression for remote clusters;
+# zstd/snappy need their Python packages. MONGO_SOCKET_TIMEOUT_MS has no default (no timeout).
+_MONGO_CLIENT_OPTIONS = [
+    # (MongoClient option, env var, default or None, type)
+    ("maxPoolSize", "MONGO_MAX_POOL_SIZE", "50", int),
+    ("minPoolSize", "MONGO_MIN_POOL_SIZE", "10", int),
+    ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000", int),
+    ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS", None, int),
+    ("compressors", "MONGO_COMPRESSORS", None, str),
+]
+
+def _mongo_client_kwargs(uri):
+    # URI option names are case-insensitive.
+    in_uri = {k.lower() for k in parse_qs(urlsplit(uri).query)}
+    kwargs = {}
+    for name, env, default, cast in _MONGO_CLIENT_OPTIONS:
+        value = os.getenv(env)
+        if not value and (default is None or name.lower() in in_uri):
+            continue
+        kwargs[name] = cast(value or default)
+    return kwargs
+
+mongo = PyMongo(app, **_mongo_client_kwargs(app.config["MONGO_URI"]))
 jwt = JWTManager(app)
 csrf = CSRFProtect(app)
 
@@ -72,64 +129,141 @@ CORS(app, resources={
 # =============================================================================
 # Indexes & seed docs
 # =============================================================================
-with app.app_context():
+# Bump when indexes or seed docs change so running workers pick them up on their next boot.
+_SCHEMA_VERSION = 15
+
+def ensure_indexes():
+    """
+    Create all indexes and seed documents; idempotent. Run once per deploy with
+    `flask init-db`. At boot it only runs when the schema marker is missing or stale.
+    """
     mongo.db.users.create_index("email", unique=True)
-    mongo.db.users.create_index([("role", 1), ("is_active", 1)])
+    # Admin user list: role/status filters + the newest-first (created_at, _id) order that
+    # `after` pagination seeks on; the unfiltered list uses (created_at, _id).
+    existing = mongo.db.users.index_information()
+    for old in ("role_1_is_active_1", "role_1_is_active_1_created_at_-1", "created_at_-1"):
+        if old in existing:
+            mongo.db.users.drop_index(old)
+    mongo.db.users.create_index([("role", 1), ("is_active", 1), ("created_at", -1), ("_id", -1)])
+    mongo.db.users.create_index([("created_at", -1), ("_id", -1)])
+    mongo.db.users.create_index("name")
     mongo.db.products.create_index("sku", unique=True)
     mongo.db.products.create_index("slug")
-    mongo.db.products.create_index([("name", "text"), ("brand", "text"), ("sku", "text")])
+    # Admin prefix searches (_prefix_regex) on name/brand; sku has its unique index.
+    mongo.db.products.create_index("name")
+    mongo.db.products.create_index("brand")
+    mongo.db.products.create_index("stock")  # dashboard low-stock list
+    # A collection holds one text index: drop earlier versions before creating the current one.
+    # SKUs stay out of it; they are matched exactly on the unique sku index (_product_search_filter).
+    existing = mongo.db.products.index_information()
+    for old in ("name_text_brand_text_sku_text", "product_text", "product_text_v2",
+                "status_1_created_at_-1", "created_at_-1"):
+        if old in existing:
+            mongo.db.products.drop_index(old)
+    mongo.db.products.create_index(
+        [("name", "text"), ("brand", "text"), ("tags", "text"), ("short_description", "text")],
+        weights={"name": 10, "brand": 5, "tags": 5, "short_description": 1}, name="product_text_v3",
+    )
+    # Storefront listings: equality on visibility (and category), then the sort key with the
+    # _id tiebreak used by `after` pagination; status != archived is applied to the index-ordered docs.
+    for old in ("visibility_1_created_at_-1", "visibility_1_category_id_1_created_at_-1",
+                "visibility_1_category_1_created_at_-1", "visibility_1_price_1"):
+        if old in existing:
+            mongo.db.products.drop_index(old)
+    mongo.db.products.create_index([("visibility", 1), ("created_at", -1), ("_id", -1)])
+    mongo.db.products.create_index([("visibility", 1), ("category_id", 1), ("created_at", -1), ("_id", -1)])
+    mongo.db.products.create_index([("visibility", 1), ("category", 1), ("created_at", -1), ("_id", -1)])
+    mongo.db.products.create_index([("visibility", 1), ("price", 1), ("_id", 1)])
+    mongo.db.products.create_index([("rating_avg", -1), ("rating_count", 1)])
+    # Admin product list, filtered by status or not, newest first.
+    mongo.db.products.create_index([("status", 1), ("created_at", -1), ("_id", -1)])
+    mongo.db.products.create_index([("created_at", -1), ("_id", -1)])
+    # Multikey indexes for the $or pre-filter of the recommendations pipeline.
+    mongo.db.products.create_index("concerns")
+    mongo.db.products.create_index("skin_types")
     mongo.db.categories.create_index("slug", unique=True)
     mongo.db.reviews.create_index([("product_id", 1), ("created_at", -1)])
     mongo.db.wishlists.create_index("user_id", unique=True)
     mongo.db.carts.create_index("user_id", unique=True)
-    mongo.db.orders.create_index([("created_at", -1)])
-    mongo.db.orders.create_index("status")
-    mongo.db.orders.create_index("user_id")
+    # "My orders" and the admin order list both sort newest first: serve filter + sort from
+    # one index each. They also cover the old single-field user_id/status indexes as prefixes,
+    # and the trailing _id serves the admin list's `after` pagination.
+    mongo.db.orders.create_index([("created_at", -1), ("_id", -1)])
+    mongo.db.orders.create_index([("user_id", 1), ("created_at", -1)])
+    mongo.db.orders.create_index([("status", 1), ("created_at", -1), ("_id", -1)])
+    # Covers the dashboard revenue aggregation (status match + created_at/total only).
+    mongo.db.orders.create_index([("status", 1), ("created_at", 1), ("total", 1)])
+    # Prefix searches of the admin order list.
+    mongo.db.orders.create_index("email")
+    mongo.db.orders.create_index("order_no")
+    existing = mongo.db.orders.index_information()
+    for old in ("user_id_1", "status_1", "created_at_-1", "status_1_created_at_-1"):
+        if old in existing:
+            mongo.db.orders.drop_index(old)
     mongo.db.ai_profiles.create_index("user_id", unique=True)
+    mongo.db.password_resets.create_index("token", unique=True)
+    mongo.db.admin_logs.create_index([("at", -1)])
+    # Async /ai/analyze jobs are only polled shortly after submission; expire them after a day.
+    mongo.db.ai_jobs.create_index("created_at", expireAfterSeconds=24 * 3600)
+
+    # $setOnInsert upserts: one round-trip each, never overwrite edited docs, and safe
+    # when several workers seed concurrently.
+    mongo.db.settings.update_one({"_id": "app"}, {"$setOnInsert": {
+        "store_name": "Beauty Commerce",
+        "currency_default": "LKR",
+        "tax_rate": 0.0,
+        "shipping_flat_rate": 0.0,
+        "updated_at": datetime.utcnow(),
+    }}, upsert=True)
+    mongo.db.attributes.update_one({"_id": "face"}, {"$setOnInsert": {
+        "skin_types": [
+            {"key": "oily_skin", "label": "Oily Skin"},
+            {"key": "dry_skin", "label": "Dry Skin"},
+            {"key": "normal_skin", "label": "Normal Skin"},
+        ],
+        "concerns": [
+            {"key": "acne", "label": "Acne"},
+            {"key": "blackheads", "label": "Blackheads"},
+            {"key": "bumps", "label": "Bumps"},
+            {"key": "dark_spots", "label": "Dark Spots"},
+            {"key": "redness", "label": "Redness"},
+            {"key": "broken_capillaries", "label": "Broken Capillaries"},
+            {"key": "bruising_discoloration", "label": "Bruising/Discoloration"},
+            {"key": "dryness_flaking", "label": "Dryness/Flaking"},
+            {"key": "texture_roughness", "label": "Texture/Roughness"},
+            {"key": "wound_barrier_damage", "label": "Wound/Barrier Damage"},
+            {"key": "oozing_crusting", "label": "Oozing/Crusting"},
+            {"key": "scarring", "label": "Scarring"},
+            {"key": "fine_lines_wrinkles", "label": "Fine Lines/Wrinkles"},
+            {"key": "blistering", "label": "Blistering"},
+            {"key": "hypopigmentation", "label": "Hypopigmentation"},
+            {"key": "discoloration", "label": "Discoloration"},
+            {"key": "warts_skin_growth", "label": "Warts/Skin Growth"},
+            {"key": "skin_tag", "label": "Skin Tag"},
+            {"key": "abnormal_growth", "label": "Abnormal Growth"},
+            {"key": "hives", "label": "Hives"},
+            {"key": "inflammation_swelling", "label": "Inflammation/Swelling"},
+            {"key": "abnormal_finding", "label": "Abnormal Finding"},
+        ],
+        "updated_at": datetime.utcnow(),
+    }}, upsert=True)
 
-    if not mongo.db.settings.find_one({"_id": "app"}):
-        mongo.db.settings.insert_one({
-            "_id": "app",
-            "store_name": "Beauty Commerce",
-            "currency_default": "LKR",
-            "tax_rate": 0.0,
-            "shipping_flat_rate": 0.0,
-            "updated_at": datetime.utcnow(),
-        })
-    if not mongo.db.attributes.find_one({"_id": "face"}):
-        mongo.db.attributes.insert_one({
-            "_id": "face",
-            "skin_types": [
-                {"key": "oily_skin", "label": "Oily Skin"},
-                {"key": "dry_skin", "label": "Dry Skin"},
-                {"key": "normal_skin", "label": "Normal Skin"},
-            ],
-            "concerns": [
-                {"key": "acne", "label": "Acne"},
-                {"key": "blackheads", "label": "Blackheads"},
-                {"key": "bumps", "label": "Bumps"},
-                {"key": "dark_spots", "label": "Dark Spots"},
-                {"key": "redness", "label": "Redness"},
-                {"key": "broken_capillaries", "label": "Broken Capillaries"},
-                {"key": "bruising_discoloration", "label": "Bruising/Discoloration"},
-                {"key": "dryness_flaking", "label": "Dryness/Flaking"},
-                {"key": "texture_roughness", "label": "Texture/Roughness"},
-                {"key": "wound_barrier_damage", "label": "Wound/Barrier Damage"},
-                {"key": "oozing_crusting", "label": "Oozing/Crusting"},
-                {"key": "scarring", "label": "Scarring"},
-                {"key": "fine_lines_wrinkles", "label": "Fine Lines/Wrinkles"},
-                {"key": "blistering", "label": "Blistering"},
-                {"key": "hypopigmentation", "label": "Hypopigmentation"},
-                {"key": "discoloration", "label": "Discoloration"},
-                {"key": "warts_skin_growth", "label": "Warts/Skin Growth"},
-                {"key": "skin_tag", "label": "Skin Tag"},
-                {"key": "abnormal_growth", "label": "Abnormal Growth"},
-                {"key": "hives", "label": "Hives"},
-                {"key": "inflammation_swelling", "label": "Inflammation/Swelling"},
-                {"key": "abnormal_finding", "label": "Abnormal Finding"},
-            ],
-            "updated_at": datetime.utcnow(),
-        })
+    mongo.db.settings.update_one(
+        {"_id": "_schema_ready"},
+        {"$set": {"version": _SCHEMA_VERSION, "updated_at": datetime.utcnow()}},
+        upsert=True,
+    )
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create MongoDB indexes and seed documents."""
+    ensure_indexes()
+    click.echo("Indexes and seed documents are up to date.")
+
+with app.app_context():
+    # One marker read per boot instead of re-issuing every createIndexes/seed check.
+    if not mongo.db.settings.find_one({"_id": "_schema_ready", "version": _SCHEMA_VERSION}, {"_id": 1}):
+        ensure_indexes()
 
 # =============================================================================
 # Helpers & Jinja
@@ -146,17 +280,96 @@ def user_to_dict(doc):
         "created_at": doc.get("created_at").isoformat() if doc.get("created_at") else None,
     }
 
-def admin_exists() -> bool:
-    return mongo.db.users.count_documents({"role": "admin"}) > 0
+def hash_password(password: str) -> str:
+    # bcrypt only reads the first 72 bytes; truncate explicitly so long passwords don't raise.
+    pw = password.encode("utf-8")[:72]
+    return bcrypt.hashpw(pw, bcrypt.gensalt(app.config["BCRYPT_ROUNDS"])).decode("ascii")
 
-def get_admin_user():
-    admin_id = session.get("admin_id")
-    if not admin_id:
-        return None
+def verify_password(stored: str, password: str):
+    """
+    (ok, needs_rehash). bcrypt hashes are checked natively; older werkzeug PBKDF2/scrypt
+    hashes still verify and come back flagged so callers can upgrade them on login.
+    """
+    if not stored:
+        return False, False
+    if stored.startswith("$2"):
+        try:
+            ok = bcrypt.checkpw(password.encode("utf-8")[:72], stored.encode("ascii"))
+        except ValueError:
+            return False, False
+        rounds = int(stored.split("$")[2])
+        return ok, ok and rounds != app.config["BCRYPT_ROUNDS"]
+    ok = check_password_hash(stored, password)
+    return ok, ok
+
+# Checked against when the account doesn't exist, so unknown and known emails cost the same.
+_DUMMY_PASSWORD_HASH = hash_password(uuid.uuid4().hex)
+
+def _rehash_password(user_id, password):
+    mongo.db.users.update_one({"_id": user_id}, {"$set": {"password_hash": hash_password(password)}})
+
+# JWT identity -> user doc (without password_hash), per process. Writes through the API and
+# admin panel drop the entry; in other workers it is at most _USER_CACHE_TTL seconds stale.
+_USER_CACHE_TTL = 30.0
+_USER_CACHE_MAX = 10_000
+_user_cache = {}  # uid -> (doc, expires_at on the monotonic clock)
+
+def get_user(uid):
+    now = time.monotonic()
+    hit = _user_cache.get(uid)
+    if hit is not None and now < hit[1]:
+        return hit[0]
     try:
-        return mongo.db.users.find_one({"_id": ObjectId(admin_id), "role": "admin"})
+        doc = mongo.db.users.find_one({"_id": ObjectId(uid)}, {"password_hash": 0})
     except Exception:
         return None
+    if len(_user_cache) >= _USER_CACHE_MAX:
+        _user_cache.clear()
+    _user_cache[uid] = (doc, now + _USER_CACHE_TTL)
+    return doc
+
+def invalidate_user(uid):
+    _user_cache.pop(str(uid), None)
+
+_ADMIN_EXISTS_TTL = 300.0
+_admin_exists_until = 0.0  # monotonic time until which a positive answer is reused
+
+def admin_exists() -> bool:
+    """
+    Only a positive answer is cached: a stale "no admin" would reopen first-admin signup.
+    """
+    global _admin_exists_until
+    now = time.monotonic()
+    if now < _admin_exists_until:
+        return True
+    exists = mongo.db.users.find_one({"role": "admin"}, {"_id": 1}) is not None
+    if exists:
+        _admin_exists_until = now + _ADMIN_EXISTS_TTL
+    return exists
+
+_ADMIN_USER_FIELDS = {"name": 1, "email": 1, "role": 1, "is_active": 1, "created_at": 1}
+# Columns of the admin product/order list pages; the 21st row fetched to detect has_next stays small.
+_ADMIN_PRODUCT_LIST_FIELDS = {"name": 1, "brand": 1, "sku": 1, "price": 1, "currency": 1, "stock": 1,
+                              "status": 1, "visibility": 1, "category": 1, "hero_image": 1, "created_at": 1}
+_ADMIN_ORDER_LIST_FIELDS = {"order_no": 1, "email": 1, "user_id": 1, "total": 1, "currency": 1,
+                            "status": 1, "created_at": 1}
+
+def get_admin_user():
+    """
+    The logged-in admin's user doc, resolved at most once per request: the login check,
+    the template context processor and log_admin all share it through `g`. Across requests
+    it comes from the get_user cache, which admin user edits invalidate.
+    """
+    if "admin_user" in g:
+        return g.admin_user
+    admin = None
+    admin_id = session.get("admin_id")
+    if admin_id:
+        admin = get_user(admin_id)
+        if admin and admin.get("role") != "admin":
+            admin = None
+    g.admin_user = admin
+    return admin
 
 def admin_login_required(view):
     @wraps(view)
@@ -174,8 +387,7 @@ def inject_globals():
 @app.template_filter("currency")
 def currency(v):
     try:
-        settings = mongo.db.settings.find_one({"_id": "app"}) or {}
-        cur = settings.get("currency_default", "LKR")
+        cur = _settings().get("currency_default", "LKR")
         return f"{cur} {float(v):,.2f}"
     except Exception:
         return "LKR 0.00"
@@ -186,40 +398,132 @@ def dt_filter(v):
         return v.strftime("%Y-%m-%d %H:%M")
     return v
 
+_STATUS_CHIP_CLASS = {
+    **dict.fromkeys(("paid", "completed", "shipped", "processing"), "bg-green-100 text-green-800"),
+    "pending": "bg-yellow-100 text-yellow-800",
+    **dict.fromkeys(("canceled", "refunded"), "bg-red-100 text-red-800"),
+}
+
 @app.template_filter("status_chip")
 def status_chip(st):
     st = (st or "").lower()
-    if st in ["paid", "completed", "shipped", "processing"]:
-        klass = "bg-green-100 text-green-800"
-    elif st in ["pending"]:
-        klass = "bg-yellow-100 text-yellow-800"
-    elif st in ["canceled", "refunded"]:
-        klass = "bg-red-100 text-red-800"
-    else:
-        klass = "bg-gray-100 text-gray-800"
+    klass = _STATUS_CHIP_CLASS.get(st, "bg-gray-100 text-gray-800")
     return f'<span class="px-2 py-0.5 rounded-full text-xs {klass}">{st.capitalize() if st else "Unknown"}</span>'
 
 def safe_count(collection, filt=None):
     try:
-        return mongo.db[collection].count_documents(filt or {})
+        if not filt:
+            # Whole-collection size: read the collection metadata instead of scanning.
+            return mongo.db[collection].estimated_document_count()
+        return mongo.db[collection].count_documents(filt)
     except Exception:
         return 0
 
-def safe_sum_orders(match=None):
+PAID_STATUSES = ["paid", "processing", "shipped", "completed"]
+# Runs the dashboard's independent queries concurrently (pymongo releases the GIL on I/O).
+_dashboard_pool = ThreadPoolExecutor(max_workers=6, thread_name_prefix="dashboard")
+
+def dashboard_user_counts():
+    """
+    (customers, admins): admins are an indexed count on the role prefix; customers are the
+    collection-metadata total minus admins, so no pass over every user is needed.
+    """
+    try:
+        admins = mongo.db.users.count_documents({"role": "admin"})
+        return max(0, mongo.db.users.estimated_document_count() - admins), admins
+    except Exception:
+        return 0, 0
+
+def dashboard_revenue(start, end):
+    """
+    All-time revenue and the per-day {date: {orders, revenue}} map for [start, end], from
+    one aggregation: the paid-status match runs once and $facet splits it into both results.
+    Only created_at and total are projected, so the (status, created_at, total) index covers
+    the scan and no order documents are fetched.
+    """
     try:
-        pipeline = [
-            {"$match": match or {}},
-            {"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$total", 0]}}}},
-        ]
-        res = list(mongo.db.orders.aggregate(pipeline))
-        return (res[0]["total"] if res else 0.0)
+        res = next(mongo.db.orders.aggregate([
+            {"$match": {"status": {"$in": PAID_STATUSES}}},
+            {"$project": {"_id": 0, "created_at": 1, "total": 1}},
+            {"$facet": {
+                "all": [{"$group": {"_id": None, "total": {"$sum": {"$ifNull": ["$total", 0]}}}}],
+                "daily": [
+                    {"$match": {"created_at": {"$gte": start, "$lte": end}}},
+                    {"$group": {
+                        "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                        "orders": {"$sum": 1},
+                        "revenue": {"$sum": {"$ifNull": ["$total", 0]}}},
+                    },
+                ],
+            }},
+        ]), {})
     except Exception:
-        return 0.0
+        res = {}
+    revenue_all = res["all"][0]["total"] if res.get("all") else 0.0
+    return revenue_all, {row["_id"]: row for row in res.get("daily", [])}
+
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+
+def _encode_after(doc, field):
+    """Opaque `after` token for the last doc of a page: its sort key value and _id."""
+    raw = json_util.dumps({"v": doc.get(field), "id": doc["_id"]})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def _after_filter(token, field, direction):
+    """
+    Keyset condition for the docs following `token` in (field, _id) order; raises ValueError
+    on a malformed token.
+    """
+    try:
+        data = json_util.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        value, oid = data["v"], data["id"]
+    except Exception as e:
+        raise ValueError("Invalid 'after' token.") from e
+    op = "$lt" if direction < 0 else "$gt"
+    return {"$or": [{field: {op: value}}, {field: value, "_id": {op: oid}}]}
+
+_NEWEST_FIRST = [("created_at", -1), ("_id", -1)]
+
+def _admin_list_page(filt, per_page):
+    """
+    (filter, skip) for a newest-first admin list. With ?after= (the previous page's next_after)
+    the page starts with an index seek instead of skipping; otherwise ?page= is honoured.
+    """
+    after = (request.args.get("after") or "").strip()
+    if not after:
+        return filt, (max(1, int(request.args.get("page", 1))) - 1) * per_page
+    try:
+        cond = _after_filter(after, "created_at", -1)
+    except ValueError:
+        abort(400)
+    return ({"$and": [filt, cond]} if "$or" in filt else {**filt, **cond}), 0
+
+_CSV_SPLIT_RE = re.compile(r"\s*,\s*")
+_LINES_SPLIT_RE = re.compile(r"\s*\n\s*")
+
+def split_csv(value):
+    """Comma-separated form input -> list of non-empty, trimmed items."""
+    return [t for t in _CSV_SPLIT_RE.split((value or "").strip()) if t]
+
+def split_lines(value):
+    """One-item-per-line textarea input -> list of non-empty, trimmed items."""
+    return [t for t in _LINES_SPLIT_RE.split((value or "").strip()) if t]
+
+def _prefix_regex(q):
+    """
+    Case-insensitive "starts with `q`" match for admin searches. Anchored and escaped, it runs
+    against index keys (no document fetch per miss) and user input can't inject regex syntax.
+    """
+    return {"$regex": "^" + re.escape(q), "$options": "i"}
 
 def slugify(name: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+    return _SLUG_RE.sub("-", name.lower()).strip("-")
 
 # ---------- ABSOLUTE URL HELPER ----------
+@lru_cache(maxsize=4096)
+def _join_url(host_url: str, path: str) -> str:
+    return urljoin(host_url, path)
+
 def abs_url(path: str | None) -> str | None:
     """
     Returns an absolute URL for a possibly-relative static path.
@@ -230,21 +534,32 @@ def abs_url(path: str | None) -> str | None:
         return None
     if str(path).startswith(("http://", "https://")):
         return path
-    return urljoin(request.host_url, str(path).lstrip("/"))
+    return _join_url(request.host_url, str(path).lstrip("/"))
 
 def save_image(file_storage, folder="products"):
-    if not file_storage or file_storage.filename == "":
+    if not file_storage or not file_storage.filename:
         return None
-    filename = secure_filename(file_storage.filename)
-    ext = Path(filename).suffix.lower()
+    # Only the client's extension is kept (the stored name is a UUID), so no sanitizing is needed.
+    ext = os.path.splitext(file_storage.filename)[1].lower()
     if ext not in ALLOWED_IMG_EXT:
         return None
     new_name = f"{uuid.uuid4().hex}{ext}"
     base_dir = UPLOAD_PRODUCTS_DIR if folder == "products" else UPLOAD_FACES_DIR
     dest_path = os.path.join(base_dir, new_name)
-    file_storage.save(dest_path)
+    with open(dest_path, "wb") as out:
+        shutil.copyfileobj(file_storage.stream, out, length=1 << 20)
     return f"/static/uploads/{folder}/{new_name}"
 
+_image_saver = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-saver")
+
+def save_images(hero, gallery, folder="products"):
+    """
+    save_image() for a hero upload and its gallery files at once, on _image_saver threads.
+    Returns (hero_path or None, [saved gallery paths in upload order]).
+    """
+    paths = list(_image_saver.map(lambda f: save_image(f, folder), [hero, *gallery]))
+    return paths[0], [p_ for p_ in paths[1:] if p_]
+
 def delete_image_if_local(web_path: str):
     if not web_path:
         return
@@ -257,45 +572,129 @@ def delete_image_if_local(web_path: str):
     except Exception:
         pass
 
-def product_or_404(product_id):
-    try:
-        _id = ObjectId(product_id)
-    except Exception:
+# Edit/delete handlers only touch the stored images of the existing product.
+_PRODUCT_IMAGE_FIELDS = {"hero_image": 1, "gallery": 1}
+
+def oid_or_404(value):
+    # Admin id routes are a favourite target of scanners; reject malformed ids with a cheap
+    # check instead of letting ObjectId raise.
+    if not ObjectId.is_valid(value):
         abort(404)
-    doc = mongo.db.products.find_one({"_id": _id})
+    return ObjectId(value)
+
+def product_or_404(product_id, projection=None):
+    doc = mongo.db.products.find_one({"_id": oid_or_404(product_id)}, projection)
     if not doc:
         abort(404)
     return doc
 
-def order_or_404(order_id):
-    try:
-        _id = ObjectId(order_id)
-    except Exception:
-        abort(404)
-    doc = mongo.db.orders.find_one({"_id": _id})
+def order_or_404(order_id, projection=None):
+    doc = mongo.db.orders.find_one({"_id": oid_or_404(order_id)}, projection)
     if not doc:
         abort(404)
     return doc
 
+# The settings doc is read by every price render and pricing call; keep it per process for
+# a short TTL. settings_update invalidates this process; other workers catch up within the TTL.
+_SETTINGS_TTL = 30.0
+_settings_cache = (None, 0.0)  # (doc, expires_at on the monotonic clock)
+
 def _settings():
-    return mongo.db.settings.find_one({"_id": "app"}) or {
-        "currency_default": "LKR", "tax_rate": 0.0, "shipping_flat_rate": 0.0
-    }
+    global _settings_cache
+    doc, expires_at = _settings_cache
+    now = time.monotonic()
+    if doc is None or now >= expires_at:
+        doc = mongo.db.settings.find_one({"_id": "app"}) or {
+            "currency_default": "LKR", "tax_rate": 0.0, "shipping_flat_rate": 0.0
+        }
+        _settings_cache = (doc, now + _SETTINGS_TTL)
+    return doc
+
+def _invalidate_settings_cache():
+    global _settings_cache
+    _settings_cache = (None, 0.0)
+
+# Product saves denormalize the category name; categories rarely change, so keep the whole
+# {category_id: name} map per process. Category writes invalidate this process, and an id
+# missing from the map (e.g. created on another worker) triggers one reload.
+_CATEGORY_NAMES_TTL = 60.0
+_category_names_cache = (None, 0.0)  # (map, expires_at on the monotonic clock)
+
+def category_name(category_id):
+    """Name of the category `category_id`, or None if there is no such category."""
+    global _category_names_cache
+    names, expires_at = _category_names_cache
+    now = time.monotonic()
+    if names is None or now >= expires_at or category_id not in names:
+        names = {str(c["_id"]): c.get("name") or "Uncategorized" for c in mongo.db.categories.find({}, {"name": 1})}
+        _category_names_cache = (names, now + _CATEGORY_NAMES_TTL)
+    return names.get(category_id)
+
+def _invalidate_category_names():
+    global _category_names_cache
+    _category_names_cache = (None, 0.0)
+
+# Pre-serialized bodies of rarely-changing storefront endpoints, keyed per endpoint and host
+# (image URLs are absolute). Admin catalog writes clear it; otherwise entries live `ttl` seconds.
+_json_cache = {}  # (endpoint, host_url) -> (body bytes, expires_at on the monotonic clock)
+
+def cached_json(ttl):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.endpoint, request.host_url)
+            now = time.monotonic()
+            hit = _json_cache.get(key)
+            if hit is not None and now < hit[1]:
+                return app.response_class(hit[0], mimetype="application/json")
+            resp = view(*args, **kwargs)
+            if resp.status_code == 200:
+                _json_cache[key] = (resp.get_data(), now + ttl)
+            return resp
+        return wrapper
+    return decorator
+
+def invalidate_cached_json():
+    _json_cache.clear()
+
+def conditional_json(view):
+    """
+    Tag 200 responses with a strong ETag of the body and answer a matching If-None-Match
+    with an empty 304. Clients revalidate every time (no-cache), so stock and price changes
+    are never served stale; unchanged responses cost no body bytes on the wire.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        resp = app.make_response(view(*args, **kwargs))
+        if resp.status_code == 200:
+            resp.add_etag()
+            resp.cache_control.no_cache = True
+            resp = resp.make_conditional(request)
+        return resp
+    return wrapper
 
 def compute_pricing(items):
     settings = _settings()
-    tax_rate = float(settings.get("tax_rate", 0.0))
+    tax_mul = float(settings.get("tax_rate", 0.0)) * 0.01
     shipping = float(settings.get("shipping_flat_rate", 0.0))
     currency = settings.get("currency_default", "LKR")
 
-    line_items, subtotal = [], 0.0
+    oids = []
     for it in items:
-        pid = it.get("product_id")
-        qty = max(1, int(it.get("qty", 1)))
         try:
-            p = mongo.db.products.find_one({"_id": ObjectId(pid)})
+            oids.append(ObjectId(it.get("product_id")))
         except Exception:
-            p = None
+            oids.append(None)
+    wanted = [oid for oid in oids if oid is not None]
+    by_id = {}
+    if wanted:
+        by_id = {p["_id"]: p for p in mongo.db.products.find(
+            {"_id": {"$in": wanted}}, {"name": 1, "sku": 1, "price": 1, "hero_image": 1})}
+
+    line_items, subtotal = [], 0.0
+    for it, oid in zip(items, oids):
+        qty = max(1, int(it.get("qty", 1)))
+        p = by_id.get(oid)
         if not p:
             continue
         price = float(p.get("price", 0.0))
@@ -308,12 +707,14 @@ def compute_pricing(items):
             "hero_image": abs_url(p.get("hero_image"))
         })
 
-    tax_total = round(subtotal * (tax_rate / 100.0), 2)
+    # Round the subtotal once so tax and total are computed from the amount shown.
+    subtotal = round(subtotal, 2)
+    tax_total = round(subtotal * tax_mul, 2)
     total = round(subtotal + tax_total + shipping, 2)
     return {
         "currency": currency,
         "items": line_items,
-        "subtotal": round(subtotal, 2),
+        "subtotal": subtotal,
         "tax_total": tax_total,
         "shipping_total": shipping,
         "total": total
@@ -341,9 +742,56 @@ class SettingsForm(Form):
 # =============================================================================
 # Admin Audit Log helper
 # =============================================================================
+# Entries are written by a background thread in batches (up to _ADMIN_LOG_BATCH, or
+# whatever arrived within _ADMIN_LOG_WAIT seconds), so admin requests never wait on the insert.
+_ADMIN_LOG_BATCH = 100
+_ADMIN_LOG_WAIT = 0.1
+_admin_log_queue = queue.Queue()
+_admin_log_writer = None
+_admin_log_lock = threading.Lock()
+
+def _write_admin_logs(batch):
+    try:
+        mongo.db.admin_logs.insert_many(batch, ordered=False)
+    except Exception:
+        app.logger.exception("Failed to write %d admin log entries.", len(batch))
+
+def _drain_admin_logs(first=None, wait=0.0):
+    batch = [] if first is None else [first]
+    deadline = time.monotonic() + wait
+    while len(batch) < _ADMIN_LOG_BATCH:
+        try:
+            batch.append(_admin_log_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    return batch
+
+def _admin_log_loop():
+    while True:
+        _write_admin_logs(_drain_admin_logs(_admin_log_queue.get(), _ADMIN_LOG_WAIT))
+
+@atexit.register
+def _flush_admin_logs():
+    while True:
+        batch = _drain_admin_logs()
+        if not batch:
+            return
+        _write_admin_logs(batch)
+
+def _ensure_admin_log_writer():
+    # Started lazily so each forked worker gets its own writer thread.
+    global _admin_log_writer
+    if _admin_log_writer is not None and _admin_log_writer.is_alive():
+        return
+    with _admin_log_lock:
+        if _admin_log_writer is None or not _admin_log_writer.is_alive():
+            _admin_log_writer = threading.Thread(target=_admin_log_loop, name="admin-log-writer", daemon=True)
+            _admin_log_writer.start()
+
 def log_admin(action, resource, resource_id=None, meta=None):
     a = get_admin_user()
-    mongo.db.admin_logs.insert_one({
+    _ensure_admin_log_writer()
+    _admin_log_queue.put({
         "at": datetime.utcnow(),
         "admin_id": str(a["_id"]) if a else None,
         "admin_email": a.get("email") if a else None,
@@ -359,69 +807,216 @@ def log_admin(action, resource, resource_id=None, meta=None):
 # =============================================================================
 _lesions_runner = None
 _conditions_runner = None
+_batcher = None
 _model_lock = threading.Lock()
+_models_ready = threading.Event()
 
 SKIN_LESIONS_WEIGHTS = os.getenv("SKIN_LESIONS_WEIGHTS", "Skin_dis_Models/best_model.pth")
 SKIN_COND_WEIGHTS = os.getenv("SKIN_COND_WEIGHTS", "Skin_conditions_Models/skin_type_best.pth")
+# INT8 ONNX exports (export_onnx) of the two models, run with onnxruntime on CPU hosts when set.
+SKIN_LESIONS_ONNX = os.getenv("SKIN_LESIONS_ONNX")
+SKIN_COND_ONNX = os.getenv("SKIN_COND_ONNX")
+# Shared automatically when both checkpoints carry the identical trunk. Otherwise only
+# enable with a lesions head trained on the conditions model's trunk, or point
+# SKIN_SHARED_TRUNK_HEAD at a head built offline by `flask distill-shared-head`.
+SKIN_SHARED_TRUNK = os.getenv("SKIN_SHARED_TRUNK", "0") == "1"
+SKIN_SHARED_TRUNK_HEAD = os.getenv("SKIN_SHARED_TRUNK_HEAD")
+# torch.compile(mode="reduce-overhead") both models, warmed up when they load. Off by default:
+# measure on the target GPU first. Needs eager models, so it excludes SKIN_SHARED_TRUNK.
+SKIN_COMPILE_MODELS = os.getenv("SKIN_COMPILE_MODELS", "0") == "1"
+# Trace + freeze + optimize_for_inference both models at load, cached as "<weights>_<device>.ts"
+# so later boots skip the rebuild. Ignored when SKIN_COMPILE_MODELS is on; excludes SKIN_SHARED_TRUNK.
+SKIN_SCRIPT_MODELS = os.getenv("SKIN_SCRIPT_MODELS", "0") == "1"
+# With SKIN_SCRIPT_MODELS: also switch off TorchScript's profiling executor for this process, so
+# the frozen modules are not re-specialized on their first calls. Affects all TorchScript code here.
+SKIN_LEGACY_JIT_EXECUTOR = os.getenv("SKIN_LEGACY_JIT_EXECUTOR", "0") == "1"
+# CUDA only, process-wide: cuDNN conv autotuning (on by default), and TF32 for FP32 math, which
+# trades FP32 precision for speed and only matters with fp16 off (off by default).
+SKIN_CUDNN_BENCHMARK = os.getenv("SKIN_CUDNN_BENCHMARK", "1") == "1"
+SKIN_TF32 = os.getenv("SKIN_TF32", "0") == "1"
+# INT8 TorchScript modules (quantize_int8) of the two models, used on CPU hosts when set and not
+# older than the FP32 weights.
+SKIN_LESIONS_INT8 = os.getenv("SKIN_LESIONS_INT8")
+SKIN_COND_INT8 = os.getenv("SKIN_COND_INT8")
+# Intra-op threads for the INT8/ONNX CPU models; unset leaves torch/onnxruntime defaults. For
+# INT8 this is torch's process-wide thread count. Keep workers x threads within the core count.
+SKIN_INT8_THREADS = int(os.getenv("SKIN_INT8_THREADS")) if os.getenv("SKIN_INT8_THREADS") else None
+# Load and warm both models on a background thread at boot instead of on the first /ai request.
+SKIN_WARM_ON_BOOT = os.getenv("SKIN_WARM_ON_BOOT", "0") == "1"
+# Batch concurrent /ai/analyze requests: up to SKIN_BATCH_MAX images gathered for at most
+# SKIN_BATCH_WAIT_MS share one forward per model. 1 (default) runs each request on its own.
+SKIN_BATCH_MAX = int(os.getenv("SKIN_BATCH_MAX", "1"))
+SKIN_BATCH_WAIT_MS = float(os.getenv("SKIN_BATCH_WAIT_MS", "5"))
+# Analyses run on a pool of SKIN_AI_WORKERS threads (bounding concurrent inference per process);
+# synchronous /ai/analyze requests give up after SKIN_AI_TIMEOUT seconds.
+SKIN_AI_WORKERS = int(os.getenv("SKIN_AI_WORKERS", str(min(4, os.cpu_count() or 1))))
+SKIN_AI_TIMEOUT = float(os.getenv("SKIN_AI_TIMEOUT", "30"))
+# New analyses are refused with 503 while this many are already queued or running in the process.
+SKIN_AI_MAX_BACKLOG = int(os.getenv("SKIN_AI_MAX_BACKLOG", str(4 * SKIN_AI_WORKERS)))
+SKIN_COMBINE_KWARGS = dict(size=224, cond_threshold=0.15, lesion_high_thr=0.30, lesion_low_thr=0.15)
+
+def _iter_calib_images(folder):
+    for name in sorted(os.listdir(folder)):
+        img = cv2.imread(os.path.join(folder, name))
+        if img is not None:
+            yield img
+
+def _build_runners(eager=False):
+    """
+    (lesions, conditions) runners as configured by the SKIN_* settings; loaded lazily.
+    `eager=True` skips compile/TorchScript/ONNX, for offline tools that need the plain models.
+    """
+    compile_model = SKIN_COMPILE_MODELS and not eager
+    script_model = SKIN_SCRIPT_MODELS and not eager
+    lesions = ModelRunner(
+        weights_path=SKIN_LESIONS_WEIGHTS,
+        labels=[
+            "Erythema","Patch","Papule","Plaque","Macule","Pustule","Crust",
+            "Brown(Hyperpigmentation)","Sclerosis","Do not consider this image","Scar",
+            "Comedo","Atrophy","Telangiectasia","Yellow","White(Hypopigmentation)",
+            "Wheal","Purple","Nodule","Black","Erosion","Scale","Ulcer","Induration",
+            "Friable","Exophytic/Fungating","Cyst","Excoriation","Warty/Papillomatous",
+            "Exudate","Poikiloderma","Dome-shaped","Acuminate","Vesicle","Bulla","Blue",
+            "Umbilicated","Lichenification","Purpura/Petechiae","Pedunculated","Xerosis",
+            "Fissure","Salmon","Gray","Translucent","Abscess","Burrow","Flat topped","Pigmented"
+        ],
+        arch="resnet50",
+        activation="sigmoid",
+        compile_model=compile_model,
+        script_model=script_model,
+        legacy_jit_executor=SKIN_LEGACY_JIT_EXECUTOR,
+        cudnn_benchmark=SKIN_CUDNN_BENCHMARK,
+        tf32=SKIN_TF32,
+        onnx_path=None if eager else SKIN_LESIONS_ONNX,
+        int8_path=None if eager else SKIN_LESIONS_INT8,
+        int8_threads=SKIN_INT8_THREADS,
+    )
+    conditions = ModelRunner(
+        weights_path=SKIN_COND_WEIGHTS,
+        labels=["Acne","Dark Spots","Oily Skin","Normal Skin","Blackheads","Dry Skin","Wrinkles"],
+        arch="resnet50",
+        activation="sigmoid",
+        compile_model=compile_model,
+        script_model=script_model,
+        legacy_jit_executor=SKIN_LEGACY_JIT_EXECUTOR,
+        cudnn_benchmark=SKIN_CUDNN_BENCHMARK,
+        tf32=SKIN_TF32,
+        onnx_path=None if eager else SKIN_COND_ONNX,
+        int8_path=None if eager else SKIN_COND_INT8,
+        int8_threads=SKIN_INT8_THREADS,
+    )
+    return lesions, conditions
 
 def _ensure_models():
-    global _lesions_runner, _conditions_runner
-    if _lesions_runner is not None and _conditions_runner is not None:
+    global _lesions_runner, _conditions_runner, _batcher
+    if _models_ready.is_set():
         return
     with _model_lock:
+        if _models_ready.is_set():
+            return
         if _lesions_runner is None:
-            _lesions_runner = ModelRunner(
-                weights_path=SKIN_LESIONS_WEIGHTS,
-                labels=[
-                    "Erythema","Patch","Papule","Plaque","Macule","Pustule","Crust",
-                    "Brown(Hyperpigmentation)","Sclerosis","Do not consider this image","Scar",
-                    "Comedo","Atrophy","Telangiectasia","Yellow","White(Hypopigmentation)",
-                    "Wheal","Purple","Nodule","Black","Erosion","Scale","Ulcer","Induration",
-                    "Friable","Exophytic/Fungating","Cyst","Excoriation","Warty/Papillomatous",
-                    "Exudate","Poikiloderma","Dome-shaped","Acuminate","Vesicle","Bulla","Blue",
-                    "Umbilicated","Lichenification","Purpura/Petechiae","Pedunculated","Xerosis",
-                    "Fissure","Salmon","Gray","Translucent","Abscess","Burrow","Flat topped","Pigmented"
-                ],
-                arch="resnet50",
-                activation="sigmoid",
-            )
-        if _conditions_runner is None:
-            _conditions_runner = ModelRunner(
-                weights_path=SKIN_COND_WEIGHTS,
-                labels=["Acne","Dark Spots","Oily Skin","Normal Skin","Blackheads","Dry Skin","Wrinkles"],
-                arch="resnet50",
-                activation="sigmoid",
-            )
-
-def _read_image_from_request() -> tuple[str, str]:
+            _lesions_runner, _conditions_runner = _build_runners()
+        if _lesions_runner._shared is None:
+            if SKIN_SHARED_TRUNK:
+                share_trunk(_conditions_runner, _lesions_runner, head_path=SKIN_SHARED_TRUNK_HEAD)
+            elif trunks_match(_conditions_runner, _lesions_runner):
+                # Identical backbones: running it once for both heads gives the same outputs.
+                share_trunk(_conditions_runner, _lesions_runner)
+        # Load under the lock so a request arriving mid-warmup waits instead of loading twice.
+        _lesions_runner._ensure_loaded()
+        _conditions_runner._ensure_loaded()
+        if SKIN_BATCH_MAX > 1 and _batcher is None:
+            _batcher = CombinedBatcher(_lesions_runner, _conditions_runner, max_batch=SKIN_BATCH_MAX,
+                                       max_wait_ms=SKIN_BATCH_WAIT_MS, **SKIN_COMBINE_KWARGS)
+        _models_ready.set()
+
+@app.cli.command("distill-shared-head")
+@click.argument("calib_dir")
+@click.argument("val_dir")
+@click.argument("out_path")
+@click.option("--max-prob-err", default=0.02, show_default=True)
+@click.option("--min-top1", default=0.95, show_default=True)
+def distill_shared_head_command(calib_dir, val_dir, out_path, max_prob_err, min_top1):
+    """Fit the lesions head onto the conditions trunk and save it if it matches the original."""
+    lesions, conditions = _build_runners(eager=True)
+    try:
+        metrics = distill_shared_head(conditions, lesions, _iter_calib_images(calib_dir),
+                                      _iter_calib_images(val_dir), out_path,
+                                      max_prob_err=max_prob_err, min_top1=min_top1)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Saved {out_path}: {metrics}. Set SKIN_SHARED_TRUNK=1 and SKIN_SHARED_TRUNK_HEAD={out_path}.")
+
+def _warm_models():
+    try:
+        _ensure_models()
+        # One forward so lazy CUDA init and cuDNN autotuning happen before the first request.
+        run_combined_AI_from_cv2(np.zeros((224, 224, 3), np.uint8), lesions_runner=_lesions_runner,
+                                 conditions_runner=_conditions_runner, **SKIN_COMBINE_KWARGS)
+    except Exception:
+        app.logger.exception("Skin model warmup failed; models will load on the first AI request.")
+
+if SKIN_WARM_ON_BOOT:
+    threading.Thread(target=_warm_models, name="skin-model-warmup", daemon=True).start()
+
+_upload_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-writer")
+_ai_pool = ThreadPoolExecutor(max_workers=SKIN_AI_WORKERS, thread_name_prefix="ai-analyze")
+_ai_backlog = 0  # analyses submitted to _ai_pool and not yet finished or cancelled
+_ai_backlog_lock = threading.Lock()
+
+def _ai_done(_fut):
+    global _ai_backlog
+    with _ai_backlog_lock:
+        _ai_backlog -= 1
+
+def _submit_ai(fn, *args):
+    """Submit to _ai_pool, counting the task in _ai_backlog until it finishes or is cancelled."""
+    global _ai_backlog
+    with _ai_backlog_lock:
+        _ai_backlog += 1
+    fut = _ai_pool.submit(fn, *args)
+    fut.add_done_callback(_ai_done)
+    return fut
+
+def _write_upload(abs_path, raw):
+    try:
+        with open(abs_path, "wb") as f:
+            f.write(raw)
+    except OSError:
+        app.logger.exception("Failed to persist uploaded image %s", abs_path)
+
+def _read_image_from_request(persist=True) -> tuple[str | None, str | None, bytes]:
     """
-    Returns (disk_web_path, disk_abs_path).
-    Supports multipart file 'file' OR base64 in JSON 'image_base64'.
+    Returns (disk_web_path, disk_abs_path, raw_bytes); both paths are None when persist=False.
+    Supports multipart file 'file' OR base64 in JSON 'image_base64'. The upload is read into
+    memory once: callers decode `raw_bytes` for inference, and the disk copy (if any) is
+    written in the background.
     """
     if "file" in request.files:
-        web = save_image(request.files["file"], folder="faces")
-        if not web:
+        fs = request.files["file"]
+        ext = os.path.splitext(fs.filename or "")[1].lower()
+        if ext not in ALLOWED_IMG_EXT:
             raise ValueError("Unsupported image type.")
-        abs_path = os.path.join(app.root_path, web.lstrip("/"))
-        return web, abs_path
-
-    data = request.get_json(silent=True) or {}
-    img_b64 = data.get("image_base64")
-    if img_b64:
+        raw = fs.read()
+    else:
+        data = request.get_json(silent=True) or {}
+        img_b64 = data.get("image_base64")
+        if not img_b64:
+            raise ValueError("No image provided. Send multipart 'file' or JSON 'image_base64'.")
         if "," in img_b64:
             img_b64 = img_b64.split(",", 1)[1]
         try:
-            raw = base64.b64decode(img_b64)
+            raw = base64.b64decode(img_b64, validate=True)
         except Exception:
             raise ValueError("Invalid base64 image.")
-        fname = f"{uuid.uuid4().hex}.jpg"
-        abs_path = os.path.join(UPLOAD_FACES_DIR, fname)
-        with open(abs_path, "wb") as f:
-            f.write(raw)
-        web = f"/static/uploads/faces/{fname}"
-        return web, abs_path
+        ext = ".jpg"
 
-    raise ValueError("No image provided. Send multipart 'file' or JSON 'image_base64'.")
+    if not persist:
+        return None, None, raw
+    fname = f"{uuid.uuid4().hex}{ext}"
+    abs_path = os.path.join(UPLOAD_FACES_DIR, fname)
+    _upload_writer.submit(_write_upload, abs_path, raw)
+    return f"/static/uploads/faces/{fname}", abs_path, raw
 
 SKIN_LABEL_TO_KEY = {
     "Oily Skin": "oily_skin",
@@ -436,6 +1031,9 @@ api = Blueprint("api", __name__, url_prefix="/api")
 csrf.exempt(api)
 
 # -------------------- Auth --------------------
+# local@domain.tld with no spaces or extra "@"; rejects "a@b." which the old split check let through.
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s.]+")
+
 @api.post("/auth/register")
 def api_register():
     data = request.get_json(force=True) or {}
@@ -446,12 +1044,12 @@ def api_register():
         return jsonify({"error": "Name, email, and password are required."}), 400
     if len(password) < 8:
         return jsonify({"error": "Password must be at least 8 characters."}), 400
-    if "@" not in email or "." not in email.split("@")[-1]:
+    if not _EMAIL_RE.fullmatch(email):
         return jsonify({"error": "Invalid email format."}), 400
     try:
         doc = {
             "name": name, "email": email,
-            "password_hash": generate_password_hash(password),
+            "password_hash": hash_password(password),
             "role": "user", "is_active": True,
             "addresses": [],
             "created_at": datetime.utcnow(),
@@ -472,10 +1070,13 @@ def api_login():
     if not email or not password:
         return jsonify({"error": "Email and password are required."}), 400
     user = mongo.db.users.find_one({"email": email})
+    ok, needs_rehash = verify_password((user or {}).get("password_hash") or _DUMMY_PASSWORD_HASH, password)
     if not user or not user.get("is_active", True):
         return jsonify({"error": "Invalid email or account inactive."}), 401
-    if not check_password_hash(user.get("password_hash", ""), password):
+    if not ok:
         return jsonify({"error": "Invalid email or password."}), 401
+    if needs_rehash:
+        _rehash_password(user["_id"], password)
     access = create_access_token(identity=str(user["_id"]))
     refresh = create_refresh_token(identity=str(user["_id"]))
     return jsonify({"access_token": access, "refresh_token": refresh, "user": user_to_dict(user)}), 200
@@ -490,11 +1091,7 @@ def api_refresh():
 @api.get("/auth/me")
 @jwt_required()
 def api_me():
-    uid = get_jwt_identity()
-    try:
-        user = mongo.db.users.find_one({"_id": ObjectId(uid)})
-    except Exception:
-        user = None
+    user = get_user(get_jwt_identity())
     if not user:
         return jsonify({"error": "User not found."}), 404
     return jsonify({"user": user_to_dict(user)}), 200
@@ -524,23 +1121,59 @@ def api_password_reset():
     user = mongo.db.users.find_one({"email": pr["email"]})
     if not user:
         return jsonify({"error": "User not found."}), 404
-    mongo.db.users.update_one({"_id": user["_id"]}, {"$set": {"password_hash": generate_password_hash(newpw)}})
+    mongo.db.users.update_one({"_id": user["_id"]}, {"$set": {"password_hash": hash_password(newpw)}})
     mongo.db.password_resets.update_one({"_id": pr["_id"]}, {"$set": {"used": True}})
     return jsonify({"ok": True})
 
 # -------------------- Catalog / Discovery --------------------
 @api.get("/categories")
+@cached_json(ttl=300)
 def api_categories():
     cats = list(mongo.db.categories.find().sort("name", 1))
     out = [{"id": str(c["_id"]), "name": c.get("name"), "slug": c.get("slug"), "item_types": c.get("item_types", [])} for c in cats]
     return jsonify({"items": out})
 
 @api.get("/attributes")
+@cached_json(ttl=300)
 def api_attributes():
     attrs = mongo.db.attributes.find_one({"_id": "face"}) or {"skin_types": [], "concerns": []}
     return jsonify(attrs)
 
+_TEXT_SCORE = {"score": {"$meta": "textScore"}}
+# Projections matching the product dicts the storefront endpoints return.
+_PRODUCT_CARD_FIELDS = {"name": 1, "brand": 1, "price": 1, "currency": 1, "hero_image": 1}
+_PUBLIC_PRODUCTS = {"visibility": "public", "status": {"$ne": "archived"}}
+
+def product_card(p):
+    """The product summary every storefront list returns; fetch with _PRODUCT_CARD_FIELDS."""
+    get = p.get
+    return {"id": str(p["_id"]), "name": get("name"), "brand": get("brand"),
+            "price": get("price", 0), "currency": get("currency", "LKR"),
+            "hero_image": abs_url(get("hero_image"))}
+# ?sort= value -> sort spec; anything unknown falls back to newest first.
+_PRODUCT_SORTS = {
+    "": [("created_at", -1)],
+    "price": [("price", 1)], "-price": [("price", -1)],
+    "name": [("name", 1)], "-name": [("name", -1)],
+}
+_PRODUCT_LIST_FIELDS = {**_PRODUCT_CARD_FIELDS, "slug": 1, "sku": 1, "stock": 1,
+                        "category": 1, "item_type": 1}
+# One token with at least one digit, e.g. "SKU-123" or "ab12": try an exact SKU match first.
+_SKU_LIKE_RE = re.compile(r"(?=[^\s]*\d)[A-Za-z0-9_-]+")
+
+def _product_search_filter(q):
+    """
+    {"sku": ...} when `q` looks like a SKU and a product has it (unique-index lookup),
+    otherwise a $text filter on name/brand.
+    """
+    if _SKU_LIKE_RE.fullmatch(q):
+        skus = list(dict.fromkeys((q, q.upper())))
+        if mongo.db.products.find_one({"sku": {"$in": skus}}, {"_id": 1}):
+            return {"sku": {"$in": skus}}
+    return {"$text": {"$search": q}}
+
 @api.get("/products")
+@conditional_json
 def api_products():
     q = (request.args.get("q") or "").strip()
     category = (request.args.get("category") or "").strip()
@@ -548,12 +1181,13 @@ def api_products():
     concern = (request.args.get("concern") or "").strip()
     skin_type = (request.args.get("skin_type") or "").strip()
     page = max(1, int(request.args.get("page", 1)))
-    per_page = min(int(request.args.get("per_page", 20)), 100)
-    sort = (request.args.get("sort") or "-created_at").strip()
+    per_page = max(1, min(int(request.args.get("per_page", 20)), 100))
+    sort = (request.args.get("sort") or "").strip()
+    after = (request.args.get("after") or "").strip()
 
-    filt = {"visibility": "public", "status": {"$ne": "archived"}}
+    filt = dict(_PUBLIC_PRODUCTS)
     if q:
-        filt["$text"] = {"$search": q}
+        filt.update(_product_search_filter(q))
     if category:
         try:
             cat = mongo.db.categories.find_one({"_id": ObjectId(category)})
@@ -567,35 +1201,38 @@ def api_products():
     if skin_type:
         filt["skin_types"] = skin_type
 
-    sort_spec = [("created_at", -1)]
-    if sort == "price":
-        sort_spec = [("price", 1)]
-    elif sort == "-price":
-        sort_spec = [("price", -1)]
-    elif sort == "name":
-        sort_spec = [("name", 1)]
-    elif sort == "-name":
-        sort_spec = [("name", -1)]
+    projection = _PRODUCT_LIST_FIELDS
+    sort_spec = _PRODUCT_SORTS.get(sort, _PRODUCT_SORTS[""])
+    if "$text" in filt and not sort:
+        # Text searches without an explicit sort come back by relevance (weighted index).
+        projection = {**_PRODUCT_LIST_FIELDS, **_TEXT_SCORE}
+        sort_spec = [("score", _TEXT_SCORE["score"])]
+
+    # Every order but relevance pages by keyset: `after` (from next_after) seeks straight to
+    # the next page on the index instead of skipping page*per_page docs. `page` still works.
+    key_field, key_dir = sort_spec[0]
+    keyset = key_field != "score"
+    if keyset:
+        sort_spec = sort_spec + [("_id", key_dir)]
+        projection = {**projection, key_field: 1}  # next_after needs the sort value
+    if after and keyset:
+        try:
+            filt.update(_after_filter(after, key_field, key_dir))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-    cur = (mongo.db.products
-           .find(filt)
-           .sort(sort_spec)
-           .skip((page-1)*per_page)
-           .limit(per_page))
-    items = []
-    for p in cur:
-        items.append({
-            "id": str(p["_id"]), "name": p.get("name"), "brand": p.get("brand"),
-            "price": p.get("price", 0), "currency": p.get("currency", "LKR"),
-            "hero_image": abs_url(p.get("hero_image")),
-            "slug": p.get("slug"),
-            "sku": p.get("sku"), "stock": p.get("stock", 0),
-            "category": p.get("category"), "item_type": p.get("item_type"),
-        })
+    cur = mongo.db.products.find(filt, projection).sort(sort_spec)
+    if not (after and keyset):
+        cur = cur.skip((page-1)*per_page)
+    docs = list(cur.limit(per_page))
+    next_after = _encode_after(docs[-1], key_field) if keyset and docs and len(docs) == per_page else None
+    items = [{**product_card(p), "slug": p.get("slug"), "sku": p.get("sku"), "stock": p.get("stock", 0),
+              "category": p.get("category"), "item_type": p.get("item_type")} for p in docs]
 
-    return jsonify({"items": items, "page": page, "per_page": per_page})
+    return jsonify({"items": items, "page": page, "per_page": per_page, "next_after": next_after})
 
 @api.get("/products/<id_or_slug>")
+@conditional_json
 def api_product_detail(id_or_slug):
     p = None
     try:
@@ -624,20 +1261,14 @@ def api_product_detail(id_or_slug):
 @api.get("/products/<product_id>/related")
 def api_product_related(product_id):
     try:
-        p = mongo.db.products.find_one({"_id": ObjectId(product_id)})
+        p = mongo.db.products.find_one({"_id": ObjectId(product_id)}, {"category": 1})
     except Exception:
         return jsonify({"items": []})
     if not p:
         return jsonify({"items": []})
-    filt = {
-        "_id": {"$ne": p["_id"]},
-        "category": p.get("category"),
-        "visibility": "public", "status": {"$ne": "archived"}
-    }
-    cur = mongo.db.products.find(filt).sort("created_at", -1).limit(8)
-    items = [{"id": str(x["_id"]), "name": x.get("name"),
-              "price": x.get("price", 0), "currency": x.get("currency", "LKR"),
-              "hero_image": abs_url(x.get("hero_image"))} for x in cur]
+    filt = {**_PUBLIC_PRODUCTS, "_id": {"$ne": p["_id"]}, "category": p.get("category")}
+    cur = mongo.db.products.find(filt, _PRODUCT_CARD_FIELDS).sort("created_at", -1).limit(8)
+    items = [product_card(x) for x in cur]
     return jsonify({"items": items})
 
 @api.get("/search")
@@ -645,25 +1276,29 @@ def api_search():
     q = (request.args.get("q") or "").strip()
     if not q:
         return jsonify({"items": []})
-    print(q)
-    cur = mongo.db.products.find({"$text": {"$search": q}, "visibility": "public"}).limit(20)
-    items = [{"id": str(p["_id"]), "name": p.get("name"), "brand": p.get("brand"),
-              "price": p.get("price", 0), "hero_image": abs_url(p.get("hero_image"))} for p in cur]
-    print(items)
+    filt = {"visibility": "public", **_product_search_filter(q)}
+    if "$text" in filt:
+        cur = (mongo.db.products.find(filt, {**_PRODUCT_CARD_FIELDS, **_TEXT_SCORE})
+               .sort([("score", _TEXT_SCORE["score"])]))
+    else:
+        cur = mongo.db.products.find(filt, _PRODUCT_CARD_FIELDS)
+    cur = cur.limit(20)
+    items = [product_card(p) for p in cur]
     return jsonify({"items": items})
 
 @api.get("/home")
+@cached_json(ttl=30)
 def api_home():
-    new_arrivals = list(mongo.db.products.find({"visibility": "public"}).sort("created_at", -1).limit(8))
-    top_rated = list(mongo.db.products.find({"rating_count": {"$gt": 2}}).sort("rating_avg", -1).limit(8))
-    budget = list(mongo.db.products.find({"price": {"$lte": 2500}, "visibility": "public"}).sort("created_at", -1).limit(8))
-    def pmap(p):
-        return {"id": str(p["_id"]), "name": p.get("name"), "price": p.get("price", 0),
-                "currency": p.get("currency", "LKR"), "hero_image": abs_url(p.get("hero_image"))}
+    new_arrivals = list(mongo.db.products.find({"visibility": "public"}, _PRODUCT_CARD_FIELDS)
+                        .sort("created_at", -1).limit(8))
+    top_rated = list(mongo.db.products.find({"rating_count": {"$gt": 2}}, _PRODUCT_CARD_FIELDS)
+                     .sort("rating_avg", -1).limit(8))
+    budget = list(mongo.db.products.find({"price": {"$lte": 2500}, "visibility": "public"}, _PRODUCT_CARD_FIELDS)
+                  .sort("created_at", -1).limit(8))
     return jsonify({
-        "new_arrivals": [pmap(x) for x in new_arrivals],
-        "top_rated": [pmap(x) for x in top_rated],
-        "budget_picks": [pmap(x) for x in budget],
+        "new_arrivals": [product_card(x) for x in new_arrivals],
+        "top_rated": [product_card(x) for x in top_rated],
+        "budget_picks": [product_card(x) for x in budget],
     })
 
 # -------------------- Reviews --------------------
@@ -686,15 +1321,32 @@ def api_reviews_list(product_id):
         })
     return jsonify({"items": items})
 
+def _apply_rating_delta(product_oid, rating, delta):
+    """
+    Add (delta=1) or remove (delta=-1) one rating from the product's running
+    rating_avg/rating_count in a single atomic pipeline update, without re-reading the reviews.
+    """
+    count = {"$ifNull": ["$rating_count", 0]}
+    total = {"$multiply": [{"$ifNull": ["$rating_avg", 0.0]}, count]}
+    new_count = {"$max": [{"$add": [count, delta]}, 0]}
+    new_avg = {"$cond": [
+        {"$gt": [new_count, 0]},
+        {"$divide": [{"$add": [total, delta * rating]}, new_count]},
+        0.0,
+    ]}
+    mongo.db.products.update_one({"_id": product_oid}, [
+        {"$set": {"rating_avg": new_avg, "rating_count": new_count}},
+    ])
+
 @api.post("/products/<product_id>/reviews")
 @jwt_required()
 def api_reviews_create(product_id):
     uid = get_jwt_identity()
+    user = get_user(uid)
     try:
-        user = mongo.db.users.find_one({"_id": ObjectId(uid)})
-        prod = mongo.db.products.find_one({"_id": ObjectId(product_id)})
+        prod = mongo.db.products.find_one({"_id": ObjectId(product_id)}, {"_id": 1})
     except Exception:
-        user, prod = None, None
+        prod = None
     if not user or not prod:
         return jsonify({"error": "Invalid user or product."}), 400
     data = request.get_json(force=True) or {}
@@ -711,14 +1363,7 @@ def api_reviews_create(product_id):
         "created_at": datetime.utcnow()
     }
     res = mongo.db.reviews.insert_one(doc)
-    agg = list(mongo.db.reviews.aggregate([
-        {"$match": {"product_id": str(prod["_id"])}},
-        {"$group": {"_id": None, "average": {"$avg": "$rating"}, "count": {"$sum": 1}}}
-    ]))
-    if agg:
-        mongo.db.products.update_one({"_id": prod["_id"]},
-                                     {"$set": {"rating_avg": float(agg[0]["average"]),
-                                               "rating_count": int(agg[0]["count"])}})
+    _apply_rating_delta(prod["_id"], rating, 1)
     return jsonify({"id": str(res.inserted_id)}), 201
 
 @api.delete("/reviews/<review_id>")
@@ -726,22 +1371,16 @@ def api_reviews_create(product_id):
 def api_reviews_delete(review_id):
     uid = get_jwt_identity()
     try:
-        r = mongo.db.reviews.find_one({"_id": ObjectId(review_id)})
+        r = mongo.db.reviews.find_one_and_delete({"_id": ObjectId(review_id), "user_id": uid},
+                                                 projection={"product_id": 1, "rating": 1})
     except Exception:
         r = None
-    if not r or r.get("user_id") != uid:
+    if not r:
         return jsonify({"error": "Not found or not allowed."}), 404
-    mongo.db.reviews.delete_one({"_id": ObjectId(review_id)})
-    prod_id = r.get("product_id")
-    agg = list(mongo.db.reviews.aggregate([
-        {"$match": {"product_id": prod_id}},
-        {"$group": {"_id": None, "average": {"$avg": "$rating"}, "count": {"$sum": 1}}}
-    ]))
-    p = mongo.db.products.find_one({"_id": ObjectId(prod_id)})
-    if p:
-        avg = float(agg[0]["average"]) if agg else 0.0
-        cnt = int(agg[0]["count"]) if agg else 0
-        mongo.db.products.update_one({"_id": p["_id"]}, {"$set": {"rating_avg": avg, "rating_count": cnt}})
+    try:
+        _apply_rating_delta(ObjectId(r.get("product_id")), int(r.get("rating", 0)), -1)
+    except Exception:
+        pass
     return jsonify({"ok": True})
 
 # -------------------- Wishlist --------------------
@@ -751,9 +1390,10 @@ def api_wishlist_get():
     uid = get_jwt_identity()
     wl = mongo.db.wishlists.find_one({"user_id": uid}) or {"items": []}
     product_ids = wl.get("items", [])
-    prods = list(mongo.db.products.find({"_id": {"$in": [ObjectId(pid) for pid in product_ids]}}))
-    items = [{"id": str(p["_id"]), "name": p.get("name"), "price": p.get("price", 0),
-              "currency": p.get("currency", "LKR"), "hero_image": abs_url(p.get("hero_image"))} for p in prods]
+    by_id = {str(p["_id"]): p for p in mongo.db.products.find(
+        {"_id": {"$in": [ObjectId(pid) for pid in product_ids]}}, _PRODUCT_CARD_FIELDS)}
+    # In wishlist order (the order items were added), not the order Mongo returned them.
+    items = [product_card(p) for pid in product_ids if (p := by_id.get(pid)) is not None]
     return jsonify({"items": items})
 
 @api.post("/wishlist/<product_id>")
@@ -778,8 +1418,9 @@ def api_wishlist_remove(product_id):
 @api.get("/addresses")
 @jwt_required()
 def api_addresses_list():
-    uid = get_jwt_identity()
-    u = mongo.db.users.find_one({"_id": ObjectId(uid)})
+    # Read straight from MongoDB, not the per-process get_user cache: an address written
+    # through another worker must show up in the very next listing.
+    u = mongo.db.users.find_one({"_id": ObjectId(get_jwt_identity())}, {"addresses": 1}) or {}
     return jsonify({"items": u.get("addresses", [])})
 
 @api.post("/addresses")
@@ -803,8 +1444,11 @@ def api_addresses_create():
     if addr["is_default"]:
         mongo.db.users.update_one({"_id": ObjectId(uid)}, {"$set": {"addresses.$[].is_default": False}})
     mongo.db.users.update_one({"_id": ObjectId(uid)}, {"$push": {"addresses": addr}})
+    invalidate_user(uid)
     return jsonify(addr), 201
 
+_ADDRESS_TEXT_FIELDS = ("name", "line1", "line2", "city", "region", "postal_code", "country", "phone")
+
 @api.put("/addresses/<addr_id>")
 @jwt_required()
 def api_addresses_update(addr_id):
@@ -812,25 +1456,21 @@ def api_addresses_update(addr_id):
     data = request.get_json(force=True) or {}
     if data.get("is_default"):
         mongo.db.users.update_one({"_id": ObjectId(uid)}, {"$set": {"addresses.$[].is_default": False}})
-    u = mongo.db.users.find_one({"_id": ObjectId(uid)})
-    addrs = u.get("addresses", [])
-    new_list = []
-    for a in addrs:
-        if a.get("id") == addr_id:
-            a.update({
-                "name": (data.get("name") or a.get("name", "")).strip(),
-                "line1": (data.get("line1") or a.get("line1", "")).strip(),
-                "line2": (data.get("line2") or a.get("line2", "")).strip(),
-                "city": (data.get("city") or a.get("city", "")).strip(),
-                "region": (data.get("region") or a.get("region", "")).strip(),
-                "postal_code": (data.get("postal_code") or a.get("postal_code", "")).strip(),
-                "country": (data.get("country") or a.get("country", "LK")).strip().upper(),
-                "phone": (data.get("phone") or a.get("phone", "")).strip(),
-                "is_default": bool(data.get("is_default", a.get("is_default", False))),
-                "updated_at": datetime.utcnow()
-            })
-        new_list.append(a)
-    mongo.db.users.update_one({"_id": ObjectId(uid)}, {"$set": {"addresses": new_list}})
+    # Only the matched address's supplied fields are written, in place: no read-modify-write
+    # of the whole addresses array.
+    fields = {}
+    for k in _ADDRESS_TEXT_FIELDS:
+        v = (data.get(k) or "").strip()
+        if v:
+            fields[k] = v.upper() if k == "country" else v
+    if "is_default" in data:
+        fields["is_default"] = bool(data["is_default"])
+    fields["updated_at"] = datetime.utcnow()
+    mongo.db.users.update_one(
+        {"_id": ObjectId(uid), "addresses.id": addr_id},
+        {"$set": {f"addresses.$.{k}": v for k, v in fields.items()}},
+    )
+    invalidate_user(uid)
     return jsonify({"ok": True})
 
 @api.delete("/addresses/<addr_id>")
@@ -838,6 +1478,7 @@ def api_addresses_update(addr_id):
 def api_addresses_delete(addr_id):
     uid = get_jwt_identity()
     mongo.db.users.update_one({"_id": ObjectId(uid)}, {"$pull": {"addresses": {"id": addr_id}}})
+    invalidate_user(uid)
     return jsonify({"ok": True})
 
 # -------------------- Cart & Checkout --------------------
@@ -858,16 +1499,20 @@ def api_cart_add():
     qty = max(1, int(data.get("qty", 1)))
     if not pid:
         return jsonify({"error": "product_id required"}), 400
-    cart = mongo.db.carts.find_one({"user_id": uid}) or {"user_id": uid, "items": []}
-    merged = False
-    for it in cart["items"]:
-        if it.get("product_id") == pid:
-            it["qty"] = it.get("qty", 1) + qty
-            merged = True
-            break
-    if not merged:
-        cart["items"].append({"product_id": pid, "qty": qty})
-    mongo.db.carts.update_one({"user_id": uid}, {"$set": {"items": cart["items"], "updated_at": datetime.utcnow()}}, upsert=True)
+    # One atomic pipeline upsert: bump the line's qty if the product is already in the cart,
+    # else append it. Concurrent adds can't overwrite each other.
+    pid_lit = {"$literal": pid}
+    items = {"$ifNull": ["$items", []]}
+    bumped = {"$map": {"input": items, "as": "it", "in": {"$cond": [
+        {"$eq": ["$$it.product_id", pid_lit]},
+        {"$mergeObjects": ["$$it", {"qty": {"$add": [{"$ifNull": ["$$it.qty", 1]}, qty]}}]},
+        "$$it",
+    ]}}}
+    appended = {"$concatArrays": [items, [{"product_id": pid_lit, "qty": qty}]]}
+    mongo.db.carts.update_one({"user_id": uid}, [{"$set": {
+        "items": {"$cond": [{"$in": [pid_lit, {"$ifNull": ["$items.product_id", []]}]}, bumped, appended]},
+        "updated_at": datetime.utcnow(),
+    }}], upsert=True)
     return jsonify({"ok": True})
 
 @api.put("/cart/items/<product_id>")
@@ -1009,27 +1654,58 @@ def api_orders_detail(order_id):
 @jwt_required()
 def api_orders_cancel(order_id):
     uid = get_jwt_identity()
-    o = mongo.db.orders.find_one({"_id": ObjectId(order_id), "user_id": uid})
-    if not o:
+    oid = ObjectId(order_id)
+    res = mongo.db.orders.update_one(
+        {"_id": oid, "user_id": uid, "status": {"$in": ["pending", "processing"]}},
+        {"$set": {"status": "canceled", "updated_at": datetime.utcnow()}},
+    )
+    if res.matched_count:
+        return jsonify({"ok": True})
+    if not mongo.db.orders.find_one({"_id": oid, "user_id": uid}, {"_id": 1}):
         return jsonify({"error": "Not found."}), 404
-    if o.get("status") not in ["pending", "processing"]:
-        return jsonify({"error": "Order cannot be canceled now."}), 400
-    mongo.db.orders.update_one({"_id": o["_id"]}, {"$set": {"status": "canceled", "updated_at": datetime.utcnow()}})
-    return jsonify({"ok": True})
+    return jsonify({"error": "Order cannot be canceled now."}), 400
 
 # -------------------- AI: Face analysis & personalized recommendations --------------------
-def _analyze_face_from_path(img_abs_path):
+# Analysis results by BLAKE2b digest of the uploaded bytes, so retries and re-uploads of the
+# same photo skip both CNN passes.
+_AI_RESULT_TTL = 3600.0
+_AI_RESULT_MAX = 1024
+_ai_result_cache = {}  # digest -> ((combined, merged), expires_at on the monotonic clock)
+
+def _analyze_face_from_path(img_abs_path, raw=None):
+    """
+    Analyze the face image at `img_abs_path`, or decode it from `raw` bytes when given
+    (skips reading back a file that may still be being written).
+    """
+    if raw is None:
+        try:
+            with open(img_abs_path, "rb") as f:
+                raw = f.read()
+        except OSError as e:
+            raise ValueError("Failed to read image.") from e
+    key = hashlib.blake2b(raw, digest_size=16).digest()
+    now = time.monotonic()
+    hit = _ai_result_cache.get(key)
+    if hit is not None and now < hit[1]:
+        return hit[0]
+
     _ensure_models()
-    img_bgr = cv2.imread(img_abs_path)
+    img_bgr = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_COLOR)
     if img_bgr is None:
         raise ValueError("Failed to read image.")
-    combined = run_combined_AI_from_cv2(
-        img_bgr,
-        lesions_runner=_lesions_runner,
-        conditions_runner=_conditions_runner,
-        size=224, cond_threshold=0.15, lesion_high_thr=0.30, lesion_low_thr=0.15
-    )
+    if _batcher is not None:
+        combined = _batcher(img_bgr)
+    else:
+        combined = run_combined_AI_from_cv2(
+            img_bgr,
+            lesions_runner=_lesions_runner,
+            conditions_runner=_conditions_runner,
+            **SKIN_COMBINE_KWARGS
+        )
     merged = merge_concerns_sections(combined)
+    if len(_ai_result_cache) >= _AI_RESULT_MAX:
+        _ai_result_cache.clear()
+    _ai_result_cache[key] = ((combined, merged), now + _AI_RESULT_TTL)
     return combined, merged
 
 @api.get("/ai/profile")
@@ -1055,63 +1731,156 @@ def api_ai_profile_delete():
     mongo.db.ai_profiles.delete_one({"user_id": uid})
     return jsonify({"ok": True})
 
+def _analyze_and_save(uid, web_path, abs_path, raw, save):
+    """Runs on _ai_pool: analyze the image and, when `save`, upsert the user's AI profile."""
+    combined, merged = _analyze_face_from_path(abs_path, raw)
+    if save:
+        doc = {
+            "user_id": uid,
+            "image_path": web_path,
+            "result": combined,
+            "merged": merged,
+            "skin_type": combined.get("skin_type", {}),
+            "updated_at": datetime.utcnow()
+        }
+        mongo.db.ai_profiles.update_one({"user_id": uid}, {"$set": doc}, upsert=True)
+    return combined, merged
+
+def _ai_error(e):
+    """(message, HTTP status) for an exception raised by _analyze_and_save."""
+    if isinstance(e, FileNotFoundError):
+        return f"Model weights not found: {e}", 503
+    return f"AI analysis failed: {e}", 500
+
+def _run_ai_job(job_id, *args):
+    try:
+        combined, merged = _analyze_and_save(*args)
+        update = {"status": "done", "result": combined, "merged": merged}
+    except Exception as e:
+        app.logger.exception("AI job %s failed", job_id)
+        msg, code = _ai_error(e)
+        update = {"status": "failed", "error": msg, "code": code}
+    update["finished_at"] = datetime.utcnow()
+    mongo.db.ai_jobs.update_one({"_id": job_id}, {"$set": update})
+
 @api.post("/ai/analyze")
 @jwt_required(optional=True)
 def api_ai_analyze():
+    """
+    Inference runs on the bounded _ai_pool (503 once SKIN_AI_MAX_BACKLOG analyses are pending).
+    By default the request waits for it (up to SKIN_AI_TIMEOUT); with ?async=1 it returns 202
+    and a job id to poll at /ai/jobs/<id>.
+    """
+    if _ai_backlog >= SKIN_AI_MAX_BACKLOG:
+        return jsonify({"error": "AI analysis is busy; try again shortly."}), 503
     uid = get_jwt_identity()
+    # persist=0 runs a one-off analysis without storing the photo (and without saving a profile).
+    persist = (request.args.get("persist") or "1").lower() not in ("0", "false", "no")
+    run_async = (request.args.get("async") or "0").lower() in ("1", "true", "yes")
     try:
-        web_path, abs_path = _read_image_from_request()
+        web_path, abs_path, raw = _read_image_from_request(persist=persist)
     except Exception as e:
         return jsonify({"error": str(e)}), 400
+    save = bool(uid and persist)
+
+    if run_async:
+        # The job id is an unguessable token, not an ObjectId: anonymous jobs all share
+        # user_id None, so the id alone is what keeps one caller's result from another.
+        job_id = secrets.token_urlsafe(32)
+        mongo.db.ai_jobs.insert_one({
+            "_id": job_id, "user_id": uid, "status": "running", "saved": save,
+            "image_path": web_path, "created_at": datetime.utcnow(),
+        })
+        _submit_ai(_run_ai_job, job_id, uid, web_path, abs_path, raw, save)
+        return jsonify({"job_id": job_id, "status": "running"}), 202
 
+    fut = _submit_ai(_analyze_and_save, uid, web_path, abs_path, raw, save)
     try:
-        combined, merged = _analyze_face_from_path(abs_path)
-
-    except FileNotFoundError as e:
-        return jsonify({"error": f"Model weights not found: {e}"}), 503
+        combined, merged = fut.result(timeout=SKIN_AI_TIMEOUT)
+    except FutureTimeout:
+        # Drop the analysis if it is still queued; one already running cannot be stopped.
+        if fut.cancel():
+            return jsonify({"error": "AI analysis timed out; retry with ?async=1."}), 503
+        msg = "AI analysis is taking longer than usual; it will still finish"
+        if save:
+            msg += " and be saved to your profile, so there is no need to retry"
+        return jsonify({"error": msg + "."}), 503
     except Exception as e:
-        return jsonify({"error": f"AI analysis failed: {e}"}), 500
-
-    if uid:
-        doc = {
-            "user_id": uid,
-            "image_path": web_path,
-            "result": combined,
-            "merged": merged,
-            "skin_type": combined.get("skin_type", {}),
-            "updated_at": datetime.utcnow()
-        }
-        mongo.db.ai_profiles.update_one({"user_id": uid}, {"$set": doc}, upsert=True)
+        msg, code = _ai_error(e)
+        return jsonify({"error": msg}), code
 
     return jsonify({
-        "saved": bool(uid),
+        "saved": save,
         "image_path": web_path,
         "image_url": abs_url(web_path),
         "result": combined,
         "merged": merged
     })
 
-def _score_product_for_profile(prod, merged_concerns, skin_label):
+@api.get("/ai/jobs/<job_id>")
+@jwt_required(optional=True)
+def api_ai_job(job_id):
+    job = mongo.db.ai_jobs.find_one({"_id": job_id, "user_id": get_jwt_identity()})
+    if not job:
+        return jsonify({"error": "Not found."}), 404
+    if job["status"] == "failed":
+        return jsonify({"status": "failed", "error": job.get("error")}), job.get("code", 500)
+    out = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "done":
+        out.update({
+            "saved": job.get("saved", False),
+            "image_path": job.get("image_path"),
+            "image_url": abs_url(job.get("image_path")),
+            "result": job.get("result"),
+            "merged": job.get("merged"),
+        })
+    return jsonify(out)
+
+def _concern_weights(merged_concerns):
+    """Per-label score weight (2 x probability); computed once per request."""
+    return {lbl: 2.0 * float(payload.get("prob", 0.0)) for lbl, payload in merged_concerns.items()}
+
+def _score_product_for_profile(prod, weights, skin_key):
     """
     Score a product based on:
-      +2 per matched concern label
+      +2 x probability per matched concern label (`weights` from _concern_weights)
       +1 if product supports user's skin type
     """
-    score = 0.0
-    matches = []
-    prod_concerns = set(prod.get("concerns", []) or [])
-    for lbl, payload in merged_concerns.items():
-        if lbl in prod_concerns:
-            score += 2.0 * float(payload.get("prob", 0.0))
-            matches.append(lbl)
-
-    skin_key = SKIN_LABEL_TO_KEY.get((skin_label or "").strip(), None)
-    if skin_key and skin_key in (prod.get("skin_types") or []):
+    prod_concerns = set(prod.get("concerns") or ())
+    matches = [c for c in weights if c in prod_concerns]
+    score = sum(weights[c] for c in matches)
+    if skin_key and skin_key in (prod.get("skin_types") or ()):
         score += 1.0
         matches.append(f"skin:{skin_key}")
 
     return score, matches
 
+_RECOMMENDATION_FIELDS = {"name": 1, "brand": 1, "price": 1, "currency": 1, "hero_image": 1,
+                          "concerns": 1, "skin_types": 1, "score": 1}
+
+def _recommendation_pipeline(weights, skin_key, limit=48):
+    """
+    The same scoring as _score_product_for_profile, run in MongoDB: only products matching a
+    concern or the skin type are scored, and only the top `limit` come back.
+    """
+    signals = [{"concerns": {"$in": list(weights)}}]
+    skin_score = 0
+    if skin_key:
+        signals.append({"skin_types": skin_key})
+        skin_score = {"$cond": [{"$in": [skin_key, {"$ifNull": ["$skin_types", []]}]}, 1, 0]}
+    concern_score = {"$sum": {"$map": {
+        "input": {"$literal": [{"k": k, "w": w} for k, w in weights.items()]}, "as": "w",
+        "in": {"$cond": [{"$in": ["$$w.k", {"$ifNull": ["$concerns", []]}]}, "$$w.w", 0]},
+    }}}
+    return [
+        {"$match": {"visibility": "public", "status": {"$ne": "archived"}, "$or": signals}},
+        {"$addFields": {"score": {"$add": [concern_score, skin_score]}}},
+        {"$match": {"score": {"$gt": 0}}},
+        {"$sort": {"score": -1, "created_at": -1}},
+        {"$limit": limit},
+        {"$project": _RECOMMENDATION_FIELDS},
+    ]
+
 @api.get("/recommendations")
 @jwt_required(optional=True)
 def api_recommendations():
@@ -1132,51 +1901,31 @@ def api_recommendations():
         concerns_csv = (request.args.get("concerns") or "").strip()
         if skin_label or concerns_csv:
             merged = {}
-            for c in [c.strip() for c in concerns_csv.split(",") if c.strip()]:
+            for c in split_csv(concerns_csv):
                 merged[c] = {"prob": 0.3, "source": ["manual"]}
         else:
-            new_arrivals = list(mongo.db.products.find({"visibility": "public"}).sort("created_at", -1).limit(24))
-            top_rated = list(mongo.db.products.find({"rating_count": {"$gt": 2}}).sort("rating_avg", -1).limit(24))
-            def p(p): return {"id": str(p["_id"]), "name": p.get("name"), "price": p.get("price", 0),
-                              "currency": p.get("currency", "LKR"), "hero_image": abs_url(p.get("hero_image"))}
+            new_arrivals = list(mongo.db.products.find({"visibility": "public"}, _PRODUCT_CARD_FIELDS)
+                                .sort("created_at", -1).limit(24))
+            top_rated = list(mongo.db.products.find({"rating_count": {"$gt": 2}}, _PRODUCT_CARD_FIELDS)
+                             .sort("rating_avg", -1).limit(24))
             return jsonify({
                 "personalized": False,
                 "reason": "No profile and no signals supplied. Showing generic picks.",
-                "new_arrivals": [p(x) for x in new_arrivals],
-                "top_rated": [p(x) for x in top_rated]
+                "new_arrivals": [product_card(x) for x in new_arrivals],
+                "top_rated": [product_card(x) for x in top_rated]
             })
 
     else:
         skin_label = (prof.get("skin_type") or {}).get("label")
         merged = prof.get("merged") or {}
 
-    candidates = list(mongo.db.products.find({
-        "visibility": "public",
-        "status": {"$ne": "archived"}
-    }).sort("created_at", -1).limit(300))
-
-    scored = []
-    for pr in candidates:
-        score, matches = _score_product_for_profile(pr, merged, skin_label)
-        if score <= 0:
-            continue
-        scored.append((score, matches, pr))
-
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = scored[:48]
+    skin_key = SKIN_LABEL_TO_KEY.get((skin_label or "").strip(), None)
+    weights = _concern_weights(merged)
+    top = [(*_score_product_for_profile(pr, weights, skin_key), pr)
+           for pr in mongo.db.products.aggregate(_recommendation_pipeline(weights, skin_key))]
 
-    items = []
-    for score, matches, p in top:
-        items.append({
-            "id": str(p["_id"]),
-            "name": p.get("name"),
-            "brand": p.get("brand"),
-            "price": p.get("price", 0),
-            "currency": p.get("currency", "LKR"),
-            "hero_image": abs_url(p.get("hero_image")),
-            "score": round(float(score), 3),
-            "matches": matches
-        })
+    items = [{**product_card(p), "score": round(float(score), 3), "matches": matches}
+             for score, matches, p in top]
 
     return jsonify({
         "personalized": True,
@@ -1211,7 +1960,7 @@ def admin_register():
         flash("Passwords do not match.", "error")
         return redirect(url_for("admin_auth"))
     try:
-        doc = {"name": name, "email": email, "password_hash": generate_password_hash(password),
+        doc = {"name": name, "email": email, "password_hash": hash_password(password),
                "role": "admin", "is_active": True, "created_at": datetime.utcnow()}
         res = mongo.db.users.insert_one(doc)
         session["admin_id"] = str(res.inserted_id)
@@ -1232,12 +1981,15 @@ def admin_login():
         return redirect(url_for("admin_auth"))
     email, password = form.email.data.strip().lower(), form.password.data
     user = mongo.db.users.find_one({"email": email})
+    ok, needs_rehash = verify_password((user or {}).get("password_hash") or _DUMMY_PASSWORD_HASH, password)
     if not user or user.get("role") != "admin" or not user.get("is_active", True):
         flash("Invalid credentials.", "error")
         return redirect(url_for("admin_auth"))
-    if not check_password_hash(user.get("password_hash", ""), password):
+    if not ok:
         flash("Invalid credentials.", "error")
         return redirect(url_for("admin_auth"))
+    if needs_rehash:
+        _rehash_password(user["_id"], password)
     session["admin_id"] = str(user["_id"])
     flash("Logged in successfully.", "success")
     return redirect(url_for("admin_dashboard"))
@@ -1252,29 +2004,20 @@ def admin_logout():
 @app.get("/admin/dashboard")
 @admin_login_required
 def admin_dashboard():
-    total_users    = safe_count("users", {"role": {"$ne": "admin"}})
-    total_admins   = safe_count("users", {"role": "admin"})
-    total_products = safe_count("products")
-    total_orders   = safe_count("orders")
-    revenue_all    = safe_sum_orders({"status": {"$in": ["paid", "processing", "shipped", "completed"]}})
     today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     start = today - timedelta(days=6)
-    match_last7 = {
-        "created_at": {"$gte": start, "$lte": today + timedelta(days=1)},
-        "status": {"$in": ["paid", "processing", "shipped", "completed"]},
-    }
-    try:
-        orders_daily = list(mongo.db.orders.aggregate([
-            {"$match": match_last7},
-            {"$group": {
-                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
-                "orders": {"$sum": 1},
-                "revenue": {"$sum": {"$ifNull": ["$total", 0]}}},
-            },
-        ]))
-        daily_map = {row["_id"]: row for row in orders_daily}
-    except Exception:
-        daily_map = {}
+    # The queries are independent (and on different collections/indexes): issue them together.
+    users_f = _dashboard_pool.submit(dashboard_user_counts)
+    products_f = _dashboard_pool.submit(safe_count, "products")
+    orders_f = _dashboard_pool.submit(safe_count, "orders")
+    revenue_f = _dashboard_pool.submit(dashboard_revenue, start, today + timedelta(days=1))
+    recent_f = _dashboard_pool.submit(lambda: list(mongo.db.orders.find().sort("created_at", -1).limit(5)))
+    low_stock_f = _dashboard_pool.submit(
+        lambda: list(mongo.db.products.find({"stock": {"$lte": 10}}).sort("stock", 1).limit(8)))
+    total_users, total_admins = users_f.result()
+    total_products = products_f.result()
+    total_orders = orders_f.result()
+    revenue_all, daily_map = revenue_f.result()
     labels, orders_series, revenue_series = [], [], []
     for i in range(7):
         d = (start + timedelta(days=i)).strftime("%Y-%m-%d")
@@ -1282,8 +2025,8 @@ def admin_dashboard():
         orders_series.append(int(daily_map.get(d, {}).get("orders", 0)))
         revenue_series.append(float(daily_map.get(d, {}).get("revenue", 0.0)))
     revenue_7d_total = sum(revenue_series)
-    recent_orders = list(mongo.db.orders.find().sort("created_at", -1).limit(5))
-    low_stock = list(mongo.db.products.find({"stock": {"$lte": 10}}).sort("stock", 1).limit(8))
+    recent_orders = recent_f.result()
+    low_stock = low_stock_f.result()
     return render_template(
         "dashboard.html",
         kpis={
@@ -1303,7 +2046,8 @@ def users_list():
     status = (request.args.get("status") or "").strip()
     filt = {}
     if q:
-        filt["$or"] = [{"name": {"$regex": q, "$options": "i"}}, {"email": {"$regex": q, "$options": "i"}}]
+        # Emails are stored lowercased, so that branch is a bounded prefix scan of the email index.
+        filt["$or"] = [{"name": _prefix_regex(q)}, {"email": {"$regex": "^" + re.escape(q.lower())}}]
     if role in ["user", "admin"]:
         filt["role"] = role
     if status == "active":
@@ -1312,19 +2056,24 @@ def users_list():
         filt["is_active"] = False
     page = max(1, int(request.args.get("page", 1)))
     per_page = 20
-    cur = mongo.db.users.find(filt).sort("created_at", -1).skip((page-1)*per_page)
+    filt, skip = _admin_list_page(filt, per_page)
+    cur = mongo.db.users.find(filt, _ADMIN_USER_FIELDS).sort(_NEWEST_FIRST).skip(skip)
     users = list(cur.limit(per_page + 1))
     has_next = len(users) > per_page
     users = users[:per_page]
-    return render_template("users_list.html", users=users, q=q, role=role, status=status, page=page, has_next=has_next)
+    next_after = _encode_after(users[-1], "created_at") if has_next else None
+    return render_template("users_list.html", users=users, q=q, role=role, status=status, page=page,
+                           has_next=has_next, next_after=next_after)
+
+def _other_active_admin(oid):
+    """Whether some active admin other than user `oid` exists."""
+    return bool(mongo.db.users.count_documents(
+        {"role": "admin", "is_active": True, "_id": {"$ne": oid}}, limit=1))
 
 @app.get("/admin/users/<user_id>")
 @admin_login_required
 def users_show(user_id):
-    try:
-        u = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    except Exception:
-        abort(404)
+    u = mongo.db.users.find_one({"_id": oid_or_404(user_id)})
     if not u:
         abort(404)
     orders = list(mongo.db.orders.find({"user_id": str(u["_id"])}).sort("created_at", -1).limit(20))
@@ -1333,10 +2082,7 @@ def users_show(user_id):
 @app.get("/admin/users/<user_id>/edit")
 @admin_login_required
 def users_edit(user_id):
-    try:
-        u = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    except Exception:
-        abort(404)
+    u = mongo.db.users.find_one({"_id": oid_or_404(user_id)})
     if not u:
         abort(404)
     return render_template("users_edit.html", u=u)
@@ -1344,63 +2090,71 @@ def users_edit(user_id):
 @app.post("/admin/users/<user_id>/edit")
 @admin_login_required
 def users_update(user_id):
-    try:
-        u = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    except Exception:
-        abort(404)
-    if not u:
-        abort(404)
-
+    oid = oid_or_404(user_id)
     name = (request.form.get("name") or "").strip()
     email = (request.form.get("email") or "").strip().lower()
-    role = (request.form.get("role") or u.get("role", "user")).strip()
+    role = (request.form.get("role") or "").strip()
     active = request.form.get("is_active") == "on"
     new_password = request.form.get("new_password") or ""
 
-    if u.get("role") == "admin":
-        admin_count = mongo.db.users.count_documents({"role": "admin", "is_active": True})
-        if (role != "admin" or not active) and admin_count <= 1:
-            flash("Cannot demote/deactivate the last active admin.", "error")
-            return redirect(url_for("users_edit", user_id=user_id))
+    if new_password and len(new_password) < 8:
+        flash("New password must be at least 8 characters.", "error")
+        return redirect(url_for("users_edit", user_id=user_id))
 
+    # Pipeline update so blank fields keep their stored value without reading the user first;
+    # form values are wrapped in $literal so a leading "$" is never taken as a field path.
     update = {
-        "name": name or u.get("name"),
-        "email": email or u.get("email"),
-        "role": role if role in ["user", "admin"] else u.get("role", "user"),
+        "name": {"$literal": name} if name else "$name",
+        "email": {"$literal": email} if email else "$email",
+        "role": role if role in ["user", "admin"] else {"$ifNull": ["$role", "user"]},
         "is_active": active,
     }
     if new_password:
-        if len(new_password) < 8:
-            flash("New password must be at least 8 characters.", "error")
+        update["password_hash"] = {"$literal": hash_password(new_password)}
+
+    # The last-admin guard runs before writing, and only for demoting/deactivating edits.
+    demoted = (role in ["user", "admin"] and role != "admin") or not active
+    if demoted and not _other_active_admin(oid):
+        if mongo.db.users.count_documents({"_id": oid, "role": "admin"}, limit=1):
+            flash("Cannot demote/deactivate the last active admin.", "error")
             return redirect(url_for("users_edit", user_id=user_id))
-        update["password_hash"] = generate_password_hash(new_password)
 
     try:
-        mongo.db.users.update_one({"_id": u["_id"]}, {"$set": update})
-        log_admin("update", "user", u["_id"], {"email": update["email"]})
-        flash("User updated.", "success")
+        before = mongo.db.users.find_one_and_update({"_id": oid}, [{"$set": update}], projection={"email": 1})
     except Exception as e:
         flash(f"Update failed: {e}", "error")
+        return redirect(url_for("users_show", user_id=user_id))
+    if not before:
+        abort(404)
+
+    invalidate_user(oid)
+    log_admin("update", "user", oid, {"email": email or before.get("email")})
+    flash("User updated.", "success")
     return redirect(url_for("users_show", user_id=user_id))
 
 @app.post("/admin/users/<user_id>/toggle-active")
 @admin_login_required
 def users_toggle_active(user_id):
-    try:
-        u = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    except Exception:
-        abort(404)
+    oid = oid_or_404(user_id)
+    filt = {"_id": oid}
+    guarded = not _other_active_admin(oid)
+    if guarded:
+        # No other active admin: only toggle this user if they are not an active admin.
+        filt["$or"] = [{"role": {"$ne": "admin"}}, {"is_active": False}]
+    u = mongo.db.users.find_one_and_update(
+        filt,
+        [{"$set": {"is_active": {"$not": [{"$ifNull": ["$is_active", True]}]}}}],
+        projection={"is_active": 1},
+        return_document=ReturnDocument.AFTER,
+    )
     if not u:
-        abort(404)
-
-    new_active = not bool(u.get("is_active", True))
-    if u.get("role") == "admin" and not new_active:
-        admin_count = mongo.db.users.count_documents({"role": "admin", "is_active": True})
-        if admin_count <= 1:
+        if guarded and mongo.db.users.count_documents({"_id": oid}, limit=1):
             flash("Cannot deactivate the last active admin.", "error")
             return redirect(url_for("users_show", user_id=user_id))
+        abort(404)
 
-    mongo.db.users.update_one({"_id": u["_id"]}, {"$set": {"is_active": new_active}})
+    new_active = u["is_active"]
+    invalidate_user(u["_id"])
     log_admin("update", "user", u["_id"], {"is_active": new_active})
     flash("User status updated.", "success")
     return redirect(url_for("users_show", user_id=user_id))
@@ -1428,7 +2182,7 @@ def users_create():
     try:
         doc = {
             "name": name, "email": email,
-            "password_hash": generate_password_hash(password),
+            "password_hash": hash_password(password),
             "role": "admin" if role == "admin" else "user",
             "is_active": True,
             "addresses": [],
@@ -1450,20 +2204,19 @@ def products_list_admin():
     status = (request.args.get("status") or "").strip()
     filt = {}
     if q:
-        filt["$or"] = [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"brand": {"$regex": q, "$options": "i"}},
-            {"sku": {"$regex": q, "$options": "i"}},
-        ]
+        filt["$or"] = [{"name": _prefix_regex(q)}, {"brand": _prefix_regex(q)}, {"sku": _prefix_regex(q)}]
     if status:
         filt["status"] = status
     page = max(1, int(request.args.get("page", 1)))
     per_page = 20
-    cur = mongo.db.products.find(filt).sort("created_at", -1).skip((page-1)*per_page)
+    filt, skip = _admin_list_page(filt, per_page)
+    cur = mongo.db.products.find(filt, _ADMIN_PRODUCT_LIST_FIELDS).sort(_NEWEST_FIRST).skip(skip)
     products = list(cur.limit(per_page + 1))
     has_next = len(products) > per_page
     products = products[:per_page]
-    return render_template("products_list.html", products=products, q=q, status=status, page=page, has_next=has_next)
+    next_after = _encode_after(products[-1], "created_at") if has_next else None
+    return render_template("products_list.html", products=products, q=q, status=status, page=page,
+                           has_next=has_next, next_after=next_after)
 
 @app.get("/admin/products/new")
 @admin_login_required
@@ -1507,25 +2260,16 @@ def products_create_admin():
     try: stock = int(stock)
     except ValueError: stock = 0
 
-    hero_path = save_image(files.get("hero_image"))
-    gallery_paths = []
-    for f in request.files.getlist("gallery"):
-        p_ = save_image(f)
-        if p_: gallery_paths.append(p_)
+    hero_path, gallery_paths = save_images(files.get("hero_image"), files.getlist("gallery"))
 
     now = datetime.utcnow()
     admin_u = get_admin_user()
-    cat = None
-    try:
-        cat = mongo.db.categories.find_one({"_id": ObjectId(category_id)})
-    except Exception:
-        pass
-    category_name = cat.get("name") if cat else "Uncategorized"
+    cat_name = category_name(category_id)
 
     doc = {
         "name": name, "brand": brand,
-        "category_id": str(cat["_id"]) if cat else None,
-        "category": category_name,
+        "category_id": category_id if cat_name is not None else None,
+        "category": cat_name or "Uncategorized",
         "item_type": item_type,
         "sku": sku, "price": price, "currency": currency, "stock": stock, "status": status,
         "skin_types": skin_types, "concerns": concerns,
@@ -1533,7 +2277,7 @@ def products_create_admin():
         "short_description": short_description, "description_html": description_html,
         "size_volume": size_volume, "country_of_origin": country_of_origin,
         "slug": slugify(name), "visibility": "public",
-        "tags": [t.strip() for t in tags_str.split(",") if t.strip()],
+        "tags": split_csv(tags_str),
         "rating_avg": 0.0, "rating_count": 0,
         "created_at": now, "updated_at": now,
         "created_by_admin_id": str(admin_u["_id"]) if admin_u else None,
@@ -1541,6 +2285,7 @@ def products_create_admin():
     }
     try:
         mongo.db.products.insert_one(doc)
+        invalidate_cached_json()
         flash("Product added successfully.", "success")
         return redirect(url_for("products_list_admin"))
     except Exception as e:
@@ -1564,7 +2309,7 @@ def products_edit_admin(product_id):
 @app.post("/admin/products/<product_id>")
 @admin_login_required
 def products_update_admin(product_id):
-    p = product_or_404(product_id)
+    oid = oid_or_404(product_id)
     form = request.form
     files = request.files
 
@@ -1598,60 +2343,63 @@ def products_update_admin(product_id):
     try: stock = int(stock)
     except ValueError: stock = 0
 
-    hero_new = save_image(files.get("hero_image"))
-    gallery_new = [p_ for f in request.files.getlist("gallery") if (p_ := save_image(f))]
+    hero_new, gallery_new = save_images(files.get("hero_image"), files.getlist("gallery"))
 
     admin_u = get_admin_user()
-    cat = None
-    try:
-        cat = mongo.db.categories.find_one({"_id": ObjectId(category_id)})
-    except Exception:
-        pass
-    category_name = cat.get("name") if cat else "Uncategorized"
+    cat_name = category_name(category_id)
 
     update = {
         "name": name, "brand": brand,
-        "category_id": str(cat["_id"]) if cat else None, "category": category_name,
+        "category_id": category_id if cat_name is not None else None,
+        "category": cat_name or "Uncategorized",
         "item_type": item_type, "sku": sku, "price": price, "currency": currency,
         "stock": stock, "status": status, "skin_types": skin_types, "concerns": concerns,
         "short_description": short_description, "description_html": description_html,
         "size_volume": size_volume, "country_of_origin": country_of_origin,
         "alt_text": alt_text, "slug": slugify(name), "visibility": "public",
-        "tags": [t.strip() for t in tags_str.split(",") if t.strip()],
+        "tags": split_csv(tags_str),
         "updated_at": datetime.utcnow(),
         "updated_by_admin_id": str(admin_u["_id"]) if admin_u else None,
     }
 
+    # Image fields are only written when they change; new gallery images are appended
+    # server-side, and the returned pre-update doc says which old files to remove.
+    changes = {"$set": update}
     if hero_new:
-        if p.get("hero_image"): delete_image_if_local(p["hero_image"])
         update["hero_image"] = hero_new
-    else:
-        update["hero_image"] = p.get("hero_image")
-
     if clear_gallery:
-        for old in p.get("gallery", []): delete_image_if_local(old)
         update["gallery"] = gallery_new
-    else:
-        update["gallery"] = (p.get("gallery") or []) + gallery_new
+    elif gallery_new:
+        changes["$push"] = {"gallery": {"$each": gallery_new}}
 
     try:
-        mongo.db.products.update_one({"_id": p["_id"]}, {"$set": update})
-        flash("Product updated.", "success")
-        return redirect(url_for("products_list_admin"))
+        p = mongo.db.products.find_one_and_update({"_id": oid}, changes, projection=_PRODUCT_IMAGE_FIELDS)
     except Exception as e:
         flash(f"Update failed: {e}", "error")
         return redirect(url_for("products_edit_admin", product_id=product_id))
+    if not p:
+        for path in [hero_new, *gallery_new]: delete_image_if_local(path)
+        abort(404)
+
+    if hero_new and p.get("hero_image"):
+        delete_image_if_local(p["hero_image"])
+    if clear_gallery:
+        for old in p.get("gallery", []): delete_image_if_local(old)
+    invalidate_cached_json()
+    flash("Product updated.", "success")
+    return redirect(url_for("products_list_admin"))
 
 @app.post("/admin/products/<product_id>/delete")
 @admin_login_required
 def products_delete_admin(product_id):
-    p = product_or_404(product_id)
+    p = product_or_404(product_id, _PRODUCT_IMAGE_FIELDS)
     if p.get("hero_image"):
         delete_image_if_local(p["hero_image"])
     for g in p.get("gallery", []):
         delete_image_if_local(g)
     try:
         mongo.db.products.delete_one({"_id": p["_id"]})
+        invalidate_cached_json()
         flash("Product deleted.", "success")
     except Exception as e:
         flash(f"Delete failed: {e}", "error")
@@ -1660,6 +2408,21 @@ def products_delete_admin(product_id):
 # ---------- Orders (admin) ----------
 ORDER_STATUSES = ["pending", "paid", "processing", "shipped", "completed", "canceled", "refunded"]
 
+def _transition_order(oid, from_status, to_status):
+    """
+    Move an order to `to_status` only if its current status matches `from_status`, in one
+    conditional update. A missing order aborts with 404; a disallowed state returns False.
+    """
+    res = mongo.db.orders.update_one(
+        {"_id": oid, "status": from_status},
+        {"$set": {"status": to_status, "updated_at": datetime.utcnow()}},
+    )
+    if res.matched_count:
+        return True
+    if not mongo.db.orders.count_documents({"_id": oid}, limit=1):
+        abort(404)
+    return False
+
 @app.get("/admin/orders")
 @admin_login_required
 def orders_list_admin():
@@ -1673,82 +2436,96 @@ def orders_list_admin():
             _id = ObjectId(q)
             filt["_id"] = _id
         except Exception:
-            filt["$or"] = [{"email": {"$regex": q, "$options": "i"}}, {"order_no": {"$regex": q, "$options": "i"}}]
+            # Emails are stored lowercased, so that branch is a bounded prefix scan of the email index.
+            filt["$or"] = [{"email": {"$regex": "^" + re.escape(q.lower())}}, {"order_no": _prefix_regex(q)}]
     page = max(1, int(request.args.get("page", 1)))
     per_page = 20
-    cur = mongo.db.orders.find(filt).sort("created_at", -1).skip((page-1)*per_page)
-    orders = list(cur.limit(per_page + 1))
+    filt, skip = _admin_list_page(filt, per_page)
+    # Page and join the ordering users in one aggregation. user_id is stored as a string, so
+    # it is converted before matching users._id.
+    orders = list(mongo.db.orders.aggregate([
+        {"$match": filt},
+        {"$sort": dict(_NEWEST_FIRST)},
+        {"$skip": skip},
+        {"$limit": per_page + 1},
+        {"$project": _ADMIN_ORDER_LIST_FIELDS},
+        {"$lookup": {
+            "from": "users",
+            "let": {"uid": {"$convert": {"input": "$user_id", "to": "objectId", "onError": None, "onNull": None}}},
+            "pipeline": [{"$match": {"$expr": {"$eq": ["$_id", "$$uid"]}}}, {"$project": _ADMIN_USER_FIELDS}],
+            "as": "user",
+        }},
+    ]))
     has_next = len(orders) > per_page
     orders = orders[:per_page]
-    user_ids = list({o.get("user_id") for o in orders if o.get("user_id")})
+    next_after = _encode_after(orders[-1], "created_at") if has_next else None
     users_map = {}
-    if user_ids:
-        udocs = mongo.db.users.find({"_id": {"$in": [ObjectId(uid) for uid in user_ids if uid]}})
-        for u in udocs:
+    for o in orders:
+        for u in o.pop("user", []):
             users_map[str(u["_id"])] = u
     return render_template("orders_list.html",
                            orders=orders, users_map=users_map,
-                           status=status, q=q, page=page, has_next=has_next,
+                           status=status, q=q, page=page, has_next=has_next, next_after=next_after,
                            ORDER_STATUSES=ORDER_STATUSES)
 
 @app.get("/admin/orders/<order_id>")
 @admin_login_required
 def orders_show_admin(order_id):
     o = order_or_404(order_id)
-    user = mongo.db.users.find_one({"_id": ObjectId(o.get("user_id"))}) if o.get("user_id") else None
+    user = get_user(o["user_id"]) if o.get("user_id") else None
     return render_template("orders_show.html", o=o, user=user, ORDER_STATUSES=ORDER_STATUSES)
 
 @app.post("/admin/orders/<order_id>/status")
 @admin_login_required
 def orders_update_status_admin(order_id):
-    o = order_or_404(order_id)
+    oid = oid_or_404(order_id)
     status = (request.form.get("status") or "").strip().lower()
     if status not in ORDER_STATUSES:
         flash("Invalid status.", "error")
         return redirect(url_for("orders_show_admin", order_id=order_id))
-    mongo.db.orders.update_one({"_id": o["_id"]}, {"$set": {"status": status, "updated_at": datetime.utcnow()}})
+    res = mongo.db.orders.update_one({"_id": oid}, {"$set": {"status": status, "updated_at": datetime.utcnow()}})
+    if not res.matched_count:
+        abort(404)
     flash("Order status updated.", "success")
     return redirect(url_for("orders_show_admin", order_id=order_id))
 
 @app.post("/admin/orders/<order_id>/note")
 @admin_login_required
 def orders_add_note_admin(order_id):
-    o = order_or_404(order_id)
+    oid = oid_or_404(order_id)
     note = (request.form.get("note") or "").strip()
     if not note:
         flash("Note cannot be empty.", "error")
         return redirect(url_for("orders_show_admin", order_id=order_id))
     admin_u = get_admin_user()
-    mongo.db.orders.update_one(
-        {"_id": o["_id"]},
+    res = mongo.db.orders.update_one(
+        {"_id": oid},
         {"$push": {"admin_notes": {
             "note": note, "at": datetime.utcnow(),
             "by": str(admin_u["_id"]) if admin_u else None,
             "by_name": admin_u.get("name") if admin_u else None
         }}}
     )
+    if not res.matched_count:
+        abort(404)
     flash("Note added.", "success")
     return redirect(url_for("orders_show_admin", order_id=order_id))
 
 @app.post("/admin/orders/<order_id>/cancel")
 @admin_login_required
 def orders_cancel_admin(order_id):
-    o = order_or_404(order_id)
-    if o.get("status") in ["completed", "refunded", "canceled"]:
+    if not _transition_order(oid_or_404(order_id), {"$nin": ["completed", "refunded", "canceled"]}, "canceled"):
         flash("Order cannot be canceled in its current state.", "error")
         return redirect(url_for("orders_show_admin", order_id=order_id))
-    mongo.db.orders.update_one({"_id": o["_id"]}, {"$set": {"status": "canceled", "updated_at": datetime.utcnow()}})
     flash("Order canceled.", "success")
     return redirect(url_for("orders_show_admin", order_id=order_id))
 
 @app.post("/admin/orders/<order_id>/refund")
 @admin_login_required
 def orders_refund_admin(order_id):
-    o = order_or_404(order_id)
-    if o.get("status") not in ["paid", "processing", "shipped", "completed"]:
+    if not _transition_order(oid_or_404(order_id), {"$in": ["paid", "processing", "shipped", "completed"]}, "refunded"):
         flash("Only paid/processed/shipped/completed orders may be refunded.", "error")
         return redirect(url_for("orders_show_admin", order_id=order_id))
-    mongo.db.orders.update_one({"_id": o["_id"]}, {"$set": {"status": "refunded", "updated_at": datetime.utcnow()}})
     flash("Order marked as refunded.", "success")
     return redirect(url_for("orders_show_admin", order_id=order_id))
 
@@ -1774,6 +2551,7 @@ def settings_update():
         "updated_at": datetime.utcnow(),
     }
     mongo.db.settings.update_one({"_id": "app"}, {"$set": data}, upsert=True)
+    _invalidate_settings_cache()
     flash("Settings updated.", "success")
     return redirect(url_for("settings_view"))
 
@@ -1792,7 +2570,7 @@ def categories_new():
 @admin_login_required
 def categories_create():
     name = (request.form.get("name") or "").strip()
-    item_types = [t.strip() for t in (request.form.get("item_types") or "").split(",") if t.strip()]
+    item_types = split_csv(request.form.get("item_types"))
     if not name:
         flash("Name required.", "error")
         return redirect(url_for("categories_new"))
@@ -1800,6 +2578,8 @@ def categories_create():
            "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()}
     try:
         mongo.db.categories.insert_one(doc)
+        invalidate_cached_json()
+        _invalidate_category_names()
         flash("Category created.", "success")
     except Exception as e:
         flash(f"Failed to create: {e}", "error")
@@ -1809,40 +2589,35 @@ def categories_create():
 @app.get("/admin/categories/<cid>/edit")
 @admin_login_required
 def categories_edit(cid):
-    try:
-        c = mongo.db.categories.find_one({"_id": ObjectId(cid)})
-    except Exception:
-        abort(404)
+    c = mongo.db.categories.find_one({"_id": oid_or_404(cid)})
     if not c: abort(404)
     return render_template("categories_edit.html", c=c)
 
 @app.post("/admin/categories/<cid>/edit")
 @admin_login_required
 def categories_update(cid):
-    try:
-        c = mongo.db.categories.find_one({"_id": ObjectId(cid)})
-    except Exception:
-        abort(404)
+    c = mongo.db.categories.find_one({"_id": oid_or_404(cid)})
     if not c: abort(404)
     name = (request.form.get("name") or "").strip()
-    item_types = [t.strip() for t in (request.form.get("item_types") or "").split(",") if t.strip()]
+    item_types = split_csv(request.form.get("item_types"))
     if not name:
         flash("Name required.", "error")
         return redirect(url_for("categories_edit", cid=cid))
     update = {"name": name, "slug": slugify(name), "item_types": item_types, "updated_at": datetime.utcnow()}
     mongo.db.categories.update_one({"_id": c["_id"]}, {"$set": update})
+    invalidate_cached_json()
+    _invalidate_category_names()
     flash("Category updated.", "success")
     return redirect(url_for("categories_list"))
 
 @app.post("/admin/categories/<cid>/delete")
 @admin_login_required
 def categories_delete(cid):
-    try:
-        c = mongo.db.categories.find_one({"_id": ObjectId(cid)})
-    except Exception:
-        abort(404)
+    c = mongo.db.categories.find_one({"_id": oid_or_404(cid)})
     if not c: abort(404)
     mongo.db.categories.delete_one({"_id": c["_id"]})
+    invalidate_cached_json()
+    _invalidate_category_names()
     flash("Category deleted.", "success")
     return redirect(url_for("categories_list"))
 
@@ -1855,8 +2630,8 @@ def attributes_view_admin():
 @app.post("/admin/attributes")
 @admin_login_required
 def attributes_update_admin():
-    skin_types_raw = [s.strip() for s in (request.form.get("skin_types") or "").splitlines() if s.strip()]
-    concerns_raw = [s.strip() for s in (request.form.get("concerns") or "").splitlines() if s.strip()]
+    skin_types_raw = split_lines(request.form.get("skin_types"))
+    concerns_raw = split_lines(request.form.get("concerns"))
 
     def to_pairs(items):
         pairs = []
@@ -1871,10 +2646,32 @@ def attributes_update_admin():
         "updated_at": datetime.utcnow()
     }
     mongo.db.attributes.update_one({"_id": "face"}, {"$set": update}, upsert=True)
+    invalidate_cached_json()
     flash("Attributes updated.", "success")
     return redirect(url_for("attributes_view_admin"))
 
 # ---------- CSV Exports ----------
+_CSV_CHUNK_ROWS = 500
+
+def _csv_response(filename, header, rows):
+    """
+    Stream `rows` as a CSV download, flushing every _CSV_CHUNK_ROWS rows: memory stays
+    bounded by one chunk however large the export, and the download starts immediately.
+    """
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(header)
+        for i, row in enumerate(rows, 1):
+            writer.writerow(row)
+            if i % _CSV_CHUNK_ROWS == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    return Response(generate(), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
 @app.get("/admin/export/orders.csv")
 @admin_login_required
 def export_orders_csv():
@@ -1894,34 +2691,36 @@ def export_orders_csv():
             except Exception: pass
         if rng: filt["created_at"] = rng
 
-    cur = mongo.db.orders.find(filt).sort("created_at", -1)
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["order_no", "date", "email", "total", "status"])
-    for o in cur:
-        writer.writerow([
-            o.get("order_no", str(o["_id"])),
-            (o.get("created_at") or datetime.utcnow()).strftime("%Y-%m-%d %H:%M"),
-            o.get("email", ""), o.get("total", 0), o.get("status", ""),
-        ])
-    return Response(output.getvalue(), mimetype="text/csv",
-                    headers={"Content-Disposition": "attachment; filename=orders.csv"})
+    # Hint the index whose order already matches the sort so large exports never hit the
+    # in-memory SORT limit; allow_disk_use is the fallback if the planner is overridden.
+    hint = [("status", 1), *_NEWEST_FIRST] if "status" in filt else _NEWEST_FIRST
+    cur = (mongo.db.orders
+           .find(filt, {"order_no": 1, "created_at": 1, "email": 1, "total": 1, "status": 1})
+           .sort(_NEWEST_FIRST)
+           .hint(hint)
+           .allow_disk_use(True)
+           .batch_size(2000))
+    rows = ([
+        o.get("order_no", str(o["_id"])),
+        (o.get("created_at") or datetime.utcnow()).strftime("%Y-%m-%d %H:%M"),
+        o.get("email", ""), o.get("total", 0), o.get("status", ""),
+    ] for o in cur)
+    return _csv_response("orders.csv", ["order_no", "date", "email", "total", "status"], rows)
 
 @app.get("/admin/export/products.csv")
 @admin_login_required
 def export_products_csv():
-    cur = mongo.db.products.find().sort("created_at", -1)
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["name", "sku", "brand", "category", "item_type", "price", "stock", "status"])
-    for p in cur:
-        writer.writerow([
-            p.get("name", ""), p.get("sku", ""), p.get("brand", ""),
-            p.get("category", ""), p.get("item_type", ""),
-            p.get("price", 0), p.get("stock", 0), p.get("status", "draft")
-        ])
-    return Response(output.getvalue(), mimetype="text/csv",
-                    headers={"Content-Disposition": "attachment; filename=products.csv"})
+    header = ["name", "sku", "brand", "category", "item_type", "price", "stock", "status"]
+    cur = (mongo.db.products
+           .find({}, dict.fromkeys(header, 1))
+           .sort("created_at", -1)
+           .batch_size(1000))
+    rows = ([
+        p.get("name", ""), p.get("sku", ""), p.get("brand", ""),
+        p.get("category", ""), p.get("item_type", ""),
+        p.get("price", 0), p.get("stock", 0), p.get("status", "draft")
+    ] for p in cur)
+    return _csv_response("products.csv", header, rows)
 
 # ---------- Root shortcuts ----------
 @app.get("/admin/auth")